@@ -0,0 +1,332 @@
+from os import path, makedirs, chdir, getcwd
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from datetime import datetime, timezone
+from subprocess import run, DEVNULL
+from argparse import ArgumentParser
+import tracemalloc
+import platform
+import json
+import sys
+import pandas as pd
+import numpy as np
+import main
+
+
+#region Constants
+SIZES = [100, 200, 400]
+SYNTHETIC_QUARTERS = [main.Q22017, main.Q32017]
+COINTEGRATED_SHARE = 0.25  # share of companies paired with a cointegrated partner
+MAX_EMPLOYERS = 3
+SINGLE_PAIRS = 200  # pairs timed through cointegrate() one at a time
+#endregion
+
+
+#region Synthetic data
+def synthetic_prices(n, days, rng):
+    """
+    Generates close prices for n companies: geometric random walks, with a
+    share of the companies replaced by a linear function of another
+    company's walk plus stationary AR(1) noise, so those pairs cointegrate
+
+    Globals:
+    COINTEGRATED_SHARE (float): Share of companies that follow a partner
+
+    Parameters:
+    n (int): Number of companies
+    days (int): Number of trading days
+    rng (numpy.random.Generator): Source of randomness
+
+    Returns:
+    prices (numpy.ndarray): Price matrix of days x companies
+    """
+
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (days, n)), axis=0))
+
+    for follower in range(0, int(n * COINTEGRATED_SHARE) * 2, 2):
+        noise = np.zeros(days)
+        shocks = rng.normal(0, 0.5, days)
+        for day in range(1, days):
+            noise[day] = 0.5 * noise[day - 1] + shocks[day]
+        prices[:, follower + 1] = 10 + rng.uniform(0.5, 2) * prices[:, follower] + noise
+
+    return prices
+
+
+def synthetic_ontology(tickers, rng):
+    """
+    Generates an N-Triples ontology of people working at companies, in the
+    vocabulary read by extract() and query()
+
+    Each company has one trading symbol and there are as many people as
+    companies, each working at one to MAX_EMPLOYERS companies. Every fifth
+    person is a director
+
+    Globals:
+    MAX_EMPLOYERS (int): Most companies a person works at
+
+    Parameters:
+    tickers (list): Trading symbol of each company
+    rng (numpy.random.Generator): Source of randomness
+
+    Returns:
+    lines (list): N-Triples statements
+    """
+
+    lines = ['<http://york.ac.uk/report/0> <{}> "{}" .'.format(main.PERIODREPORT, "synthetic")]
+
+    for company, ticker in enumerate(tickers):
+        lines.append('<http://york.ac.uk/company/{}> <{}> "{}" .'.format(
+            company, main.TRADINGSYMBOL, ticker))
+
+    for person in range(len(tickers)):
+        uri = "<http://york.ac.uk/person/{}>".format(person)
+        lines.append('{} <{}> "Person {}" .'.format(uri, main.NAME, person))
+        if person % 5 == 0:
+            lines.append('{} <{}> "true"^^<http://www.w3.org/2001/XMLSchema#boolean> .'.format(
+                uri, main.ISDIRECTOR))
+
+        employers = rng.choice(len(tickers), rng.integers(1, MAX_EMPLOYERS + 1), replace=False)
+        for company in employers:
+            lines.append("{} <{}> <http://york.ac.uk/company/{}> .".format(uri, main.WORKSAT, company))
+
+    return lines
+
+
+def write_universe(n, seed):
+    """
+    Writes a synthetic universe of n companies into the working directory:
+    per-ticker price caches for every quarter in SYNTHETIC_QUARTERS and an
+    ontology for the first
+
+    Globals:
+    SYNTHETIC_QUARTERS (list): Quarters to generate prices for
+
+    Parameters:
+    n (int): Number of companies
+    seed (int): Seed for reproducible universes
+
+    Returns:
+    tickers (list): Trading symbols of the companies
+    """
+
+    rng = np.random.default_rng(seed)
+    tickers = ["T{}".format(i) for i in range(n)]
+
+    for obj in SYNTHETIC_QUARTERS:
+        directory = "stocks/{}".format(obj.folder)
+        makedirs(directory, exist_ok=True)
+        dates = obj.dates
+        prices = synthetic_prices(n, obj.days, rng)
+
+        for i, ticker in enumerate(tickers):
+            pd.DataFrame({"Date": dates, "Close": prices[:, i]}).to_csv(
+                path.join(directory, "{}.csv".format(ticker)), index=False)
+
+    directory = "data/{}".format(SYNTHETIC_QUARTERS[0].folder)
+    makedirs(directory, exist_ok=True)
+    with open(path.join(directory, "synthetic.nt"), "w") as outfile:
+        outfile.write("\n".join(synthetic_ontology(tickers, rng)) + "\n")
+
+    return tickers
+#endregion
+
+
+#region Timing
+def measure(stage, function, pairs=None):
+    """
+    Runs one stage, recording its wall time and peak traced memory
+
+    Parameters:
+    stage (string): Name of the stage
+    function (function): Stage to run, called without arguments
+    pairs (function or int, default: None): Number of pairs the stage
+    processed, or a function of its return value giving it, used for
+    throughput
+
+    Returns:
+    output: Return value of function
+    record (dictionary): Stage measurements
+    """
+
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = perf_counter()
+    output = function()
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+
+    record = {"stage": stage, "seconds": seconds, "peak_bytes": max(peak, 0)}
+    if callable(pairs):
+        pairs = pairs(output)
+    if pairs is not None:
+        record["pairs"] = pairs
+        record["pairs_per_second"] = pairs / seconds if seconds > 0 else None
+
+    return output, record
+
+
+def reset():
+    """
+    Clears the cointegration results and price panel held by main, so each
+    stage does its own work
+    """
+
+    main.RESULTS.clear()
+    main.PANEL = None
+
+
+def benchmark_universe(n, seed, random_set_size):
+    """
+    Times each stage of the pipeline on a synthetic universe of n companies,
+    written to the working directory
+
+    Parameters:
+    n (int): Number of companies
+    seed (int): Seed for reproducible universes
+    random_set_size (int): Number of pairs in the random set
+
+    Returns:
+    records (list): Stage measurements, as returned by measure()
+    """
+
+    first, second = SYNTHETIC_QUARTERS[:2]
+    tickers = write_universe(n, seed)
+    records = []
+
+    def record(stage, function, pairs=None):
+        output, measurement = measure(stage, function, pairs)
+        records.append(measurement)
+        return output
+
+    main.set_quarter(first)
+    reset()
+    record("load_prices", lambda: main.get_panel().load(tickers))
+
+    graph = record("populate", main.populate)
+    rows = record("query", lambda: list(main.query(graph, main.employee_type.EMPLOYEE)))
+    employee_dict = record("pairs_with_links", lambda: main.pairs_with_links(rows), len)
+    ontology = record("load_ontology", main.load_ontology)
+    record("linked_pairs", lambda: main.linked_pairs(ontology, main.employee_type.EMPLOYEE), len)
+
+    companies = [str(row[0]).upper() for row in ontology.query(main.employee_type.ALL)]
+    random_pairs = record("generate_random_set", lambda: main.generate_random_set(
+        companies, random_set_size, exclusion_list=set(employee_dict)), len)
+
+    reset()
+    record("cointegrate_batch", lambda: main.cointegrate_batch(random_pairs), len(random_pairs))
+
+    reset()
+    single = random_pairs[:SINGLE_PAIRS]
+    record("cointegrate", lambda: [main.cointegrate(*pair) for pair in single], len(single))
+
+    reset()
+    record("sliding_new", lambda: main.sliding_new(main.employee_type.ALL, random_pairs),
+           len(random_pairs))
+
+    main.set_quarter(second)
+    reset()
+    main.get_panel().load(tickers)
+    record("sliding_existing", lambda: main.sliding_existing(main.employee_type.ALL, first.folder),
+           len(random_pairs))
+
+    for measurement in records:
+        measurement["companies"] = n
+
+    return records
+
+
+def revision():
+    """
+    Commit of the checked out code, so results can be compared between
+    versions
+
+    Returns:
+    revision (string): Commit hash, None outside a git checkout
+    """
+
+    try:
+        output = run(["git", "rev-parse", "HEAD"], cwd=path.dirname(path.abspath(__file__)),
+                     capture_output=True, text=True, stdin=DEVNULL)
+    except OSError:
+        return None
+
+    return output.stdout.strip() or None
+
+
+def run_benchmark(sizes, seed=0, random_set_size=2000, workers=1):
+    """
+    Benchmarks every universe size, each in a fresh temporary directory
+
+    Globals:
+    main.DATA_SOURCE (YahooSource or DirectorySource): Redirected to the
+    temporary directory so no stage reaches the network
+    main.WORKERS (int): Set to workers
+
+    Parameters:
+    sizes (list): Numbers of companies
+    seed (int, default: 0): Seed for reproducible universes
+    random_set_size (int, default: 2000): Number of pairs in the random set
+    workers (int, default: 1): Number of worker processes for cointegration
+
+    Returns:
+    report (dictionary): Environment and stage measurements
+    """
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "seed": seed,
+        "random_set_size": random_set_size,
+        "workers": workers,
+        "results": [],
+    }
+    cwd = getcwd()
+    main.WORKERS = workers
+
+    tracemalloc.start()
+    try:
+        for n in sizes:
+            with TemporaryDirectory() as directory:
+                chdir(directory)
+                main.DATA_SOURCE = main.DirectorySource(path.join(directory, "prices"))
+                makedirs("experiments/random_no_links", exist_ok=True)
+                try:
+                    report["results"].extend(benchmark_universe(n, seed, random_set_size))
+                finally:
+                    chdir(cwd)
+                    reset()
+    finally:
+        tracemalloc.stop()
+
+    return report
+#endregion
+
+
+#region Command line
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Time each stage of the pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, metavar="N",
+                        help="numbers of companies to benchmark (default: {})".format(
+                            " ".join(str(size) for size in SIZES)))
+    parser.add_argument("--random-set-size", type=int, default=2000,
+                        help="pairs in the random set (default: 2000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes used for cointegration (default: 1, serial)")
+    parser.add_argument("--output", default="-", help="output file, - for stdout (default: -)")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes, args.seed, args.random_set_size, args.workers)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+#endregion
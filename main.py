@@ -1,15 +1,39 @@
-from os import path
-from random import choice
+from os import path, makedirs, replace, remove, cpu_count
+from time import sleep, perf_counter, time
+from random import Random
+from math import isqrt
 from enum import Enum
-from statsmodels.tsa.stattools import coint
-from statsmodels.tsa.vector_ar.vecm import coint_johansen
+from statsmodels.tsa.coint_tables import c_sjt
+from statsmodels.tsa.adfvalues import mackinnonp
+try:  # private coefficient tables of mackinnonp(), checked against it where mackinnon_p() is defined
+    from statsmodels.tsa.adfvalues import _tau_maxs, _tau_mins, _tau_stars, _tau_smallps, _tau_largeps
+except ImportError:
+    _tau_maxs = None
+from scipy.stats import norm
 import pandas as pd
 import yfinance as yf
-from rdflib import Graph
+from yfinance.exceptions import YFTickerMissingError, YFTzMissingError
+from rdflib import Graph, Literal, URIRef
+from hashlib import sha256
+from functools import lru_cache, partial
+from contextlib import contextmanager, nullcontext
+import re
+import json
+import sys
+import csv
 from pickle import dump, load
-from itertools import combinations
+from itertools import combinations, islice
+from heapq import nsmallest
 from glob import glob
-from ast import literal_eval
+from urllib.parse import urlsplit, parse_qs
+import asyncio
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 #region Classes
@@ -26,23 +50,268 @@ class employee_type(Enum):
 
 
 class Quarter:
-    def __init__(self, start, end, days, folder):
+    def __init__(self, start, end, days, folder, dates=None):
         self.start = start
         self.end = end
         self.days = days
         self.folder = folder
+        self.dates = dates  # trading days, None to take the dates from the price data
+
+
+class Rolling(Quarter):  # windows of days trading days between start and end, every step trading days
+    def __init__(self, start, end, days, step, folder):
+        super().__init__(start, end, days, folder)
+        self.step = step
+
+
+class Calendar:
+    def __init__(self, holidays):
+        self.holidays = pd.DatetimeIndex(pd.to_datetime(holidays))
+        self.years = set(self.holidays.year)
+
+    def trading_days(self, start, end):
+        """
+        Trading days between start and end inclusive: weekdays that are not
+        exchange holidays
+
+        Parameters:
+        start (datetime): First day of the range
+        end (datetime): Last day of the range
+
+        Returns:
+        dates (pandas.DatetimeIndex): Trading days
+
+        Raises:
+        ValueError: If the holiday table does not cover the range
+        """
+
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if not self.covers(start, end):
+            uncovered = [year for year in range(start.year, end.year + 1) if year not in self.years]
+            raise ValueError("No exchange holidays for {}".format(", ".join(map(str, uncovered))))
+
+        dates = pd.bdate_range(start, end, name="Date")
+
+        return dates[~dates.isin(self.holidays)]
+
+    def covers(self, start, end):
+        """
+        Checks whether the holiday table covers every year from start to end
+
+        Parameters:
+        start (datetime): First day of the range
+        end (datetime): Last day of the range
+
+        Returns:
+        covered (bool): Whether trading_days() can be used for the range
+        """
+
+        return all(year in self.years for year in range(pd.Timestamp(start).year, pd.Timestamp(end).year + 1))
+
+    def quarter(self, name, dates=None):
+        """
+        Creates a Quarter from its name, e.g. "2018Q3", counting its trading
+        days instead of relying on a hand-written count
+
+        Parameters:
+        name (string): Year and quarter number
+        dates (pandas.DatetimeIndex, default: None): Trading days to use in
+        place of the holiday table, e.g. from observed_calendar()
+
+        Returns:
+        quarter (Quarter): Quarter with its trading days
+        """
+
+        match = QUARTER_NAME.fullmatch(name)
+        if match is None:
+            raise ValueError("Quarters are named like 2018Q3, not {}".format(name))
+
+        start = pd.Timestamp(int(match.group(1)), 3 * int(match.group(2)) - 2, 1)
+        end = start + pd.offsets.QuarterEnd(0)
+
+        if dates is None:
+            dates = self.trading_days(start, end)
+        else:
+            dates = pd.DatetimeIndex(dates, name="Date")
+            dates = dates[(dates >= start) & (dates <= end)]
+
+        return Quarter(start.date().isoformat(), end.date().isoformat(), len(dates), name, dates)
+
+
+class YahooSource:
+    def __init__(self):
+        yf.config.debug.hide_exceptions = False  # raise missing tickers and prices rather than logging them
+
+    def fetch(self, ticker, start, end):
+        """
+        Downloads close of day prices from Yahoo Finance
+
+        Parameters:
+        ticker (string): Stock ticker
+        start (datetime): Start of period
+        end (datetime): End of period
+
+        Returns:
+        series (pandas.DataFrame): DataFrame with Date and Close columns
+        """
+
+        end = pd.Timestamp(end) + pd.Timedelta(days=1)  # Yahoo's end date is exclusive
+        try:  # network, rate limit and timezone errors are raised as they are
+            series = yf.Ticker(ticker).history(start=start, end=end)
+        except YFTzMissingError:
+            raise  # also raised after a failed request, when yfinance caches the missing timezone
+        except YFTickerMissingError as error:  # including YFPricesMissingError
+            raise ValueError("No prices for {}: {}".format(ticker, error)) from error
+
+        if series.empty or "Close" not in series:
+            raise ValueError("No prices for {}".format(ticker))
+
+        series.index = series.index.tz_localize(None).rename("Date")
+
+        return series.filter(["Close"]).reset_index(drop=False)
+
+
+class DirectorySource:
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, ticker, start, end):
+        """
+        Reads close of day prices from <root>/<ticker>.csv, e.g. a fixture
+        directory used in place of Yahoo Finance
+
+        Parameters:
+        ticker (string): Stock ticker
+        start (datetime): Start of period
+        end (datetime): End of period
+
+        Returns:
+        series (pandas.DataFrame): DataFrame with Date and Close columns
+        """
+
+        directory = path.join(self.root, "{}.csv".format(ticker))
+        if not path.isfile(directory):
+            raise ValueError("No prices for {}".format(ticker))
+
+        series = pd.read_csv(directory)
+        series["Date"] = pd.to_datetime(series["Date"])
+
+        return series[(series["Date"] >= start) & (series["Date"] <= end)][["Date", "Close"]]
+
+
+class Ontology:
+    def __init__(self, names, employment, directors, tickers, has_period):
+        self.names = names
+        self.employment = employment
+        self.directors = directors
+        self.tickers = tickers
+        self.has_period = has_period
+
+    def query(self, type):
+        """
+        Answers query() from the extracted edges without rdflib
+
+        Parameters:
+        type (employee_type): Employee type to query ontology for
+
+        Returns:
+        query (list): List of tuples in format (person, name, ticker1,
+        ticker2) in the case of director/employee; list of (ticker,) tuples
+        for every company in the ontology otherwise
+        """
+
+        if type == employee_type.ALL:
+            return [(ticker,) for ticker in self.tickers]
+
+        rows = []
+
+        for person, tickers in self.employment.items():
+            if type == employee_type.DIRECTOR and (person not in self.directors or not self.has_period):
+                continue
+
+            for name in self.names.get(person, []):
+                rows.extend((person, name, ticker1, ticker2)
+                            for ticker1 in tickers for ticker2 in tickers if ticker1 != ticker2)
+
+        return rows
 #endregion
 
 
 #region Constants
-Q22017 = Quarter("2017-04-01", "2017-06-30", 63, "2017Q2")
-Q32017 = Quarter("2017-07-01", "2017-09-30", 64, "2017Q3")
-Q42017 = Quarter("2017-10-01", "2017-12-31", 63, "2017Q4")
-Q12018 = Quarter("2018-01-01", "2018-03-31", 61, "2018Q1")
-Q22018 = Quarter("2018-04-01", "2018-06-30", 64, "2018Q2")
+QUARTER_NAME = re.compile(r"(\d{4})Q([1-4])")
+NYSE = Calendar([  # full-day closures
+    "2016-01-01", "2016-01-18", "2016-02-15", "2016-03-25", "2016-05-30",
+    "2016-07-04", "2016-09-05", "2016-11-24", "2016-12-26",
+    "2017-01-02", "2017-01-16", "2017-02-20", "2017-04-14", "2017-05-29",
+    "2017-07-04", "2017-09-04", "2017-11-23", "2017-12-25",
+    "2018-01-01", "2018-01-15", "2018-02-19", "2018-03-30", "2018-05-28",
+    "2018-07-04", "2018-09-03", "2018-11-22", "2018-12-05", "2018-12-25",
+    "2019-01-01", "2019-01-21", "2019-02-18", "2019-04-19", "2019-05-27",
+    "2019-07-04", "2019-09-02", "2019-11-28", "2019-12-25",
+])
+Q22017 = NYSE.quarter("2017Q2")
+Q32017 = NYSE.quarter("2017Q3")
+Q42017 = NYSE.quarter("2017Q4")
+Q12018 = NYSE.quarter("2018Q1")
+Q22018 = NYSE.quarter("2018Q2")
 OBJECT_LIST = [Q22017, Q32017, Q42017, Q12018, Q22018]
-GRAPH_CACHE = "/tmp/graph.cache"
+ONTOLOGY_CACHE = "data/{}/.ontology.json"
+WORKSAT = URIRef("http://york.ac.uk/worksat")
+ISDIRECTOR = URIRef("http://york.ac.uk/isdirector")
+TRADINGSYMBOL = URIRef("http://york.ac.uk/tradingsymbol")
+PERIODREPORT = URIRef("http://york.ac.uk/periodreport")
+NAME = URIRef("http://xmlns.com/foaf/0.1/name")
+TICKER_REPLACEMENTS = {  # applied in order after "." is replaced with "-", later cases see earlier output
+    "CRDA CRDB": "CRDA",
+    "CRDA-CRDB": "CRDB",
+    "FCE-A/FCEB": "FCEA",
+    "FCEA/FCEB": "FCEB",
+    "BFA, BFB": "BFB",
+}
+TICKER_EXCHANGES = ["NASDAQ", "NYSE"]
+TICKER_SYMBOLS = str.maketrans("", "", '*:/ []"')
+CLEAN_CACHE_SIZE = 1 << 16
+RESULT_LABELS = np.array(["True", "False", "DISSOLVED", ""], dtype=object)  # indexed by coint_return value, -1 if untested
+LEGACY_PAIR = r"^\('(.*)', '(.*)'\)$"
+RESULT_FILE = re.compile(r"(?:employee_(\d+)|random)_(\d{4}Q[1-4])\.csv")
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
 RANDOM_SET_SIZE = 50000
+LINK_INTERVALS = [1, 2, 3, 4, 5]  # minimum numbers of links of the linked sets
+RANDOM_SEED = 0
+WORKERS = 1
+WORKER_STORE = None  # (binary store, columns) memory-mapped by a service worker
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+DATA_SOURCE = YahooSource()
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
+MISSING_TTL = 7 * 24 * 60 * 60  # seconds before a ticker with no prices is tried again
+PANEL_STORE = "stocks/{}/panel.npy"
+PANEL_INDEX = "stocks/{}/panel.json"
+CHECKPOINT_FILE = "experiments/checkpoint_{}.cache"
+CHECKPOINT_INTERVAL = 10000
+CHECKPOINTING = False
+ROLLING_FILE = "experiments/rolling/rolling_{}.csv"
+CHUNK_SIZE = 5000
+SCAN_TILE = 64  # tickers per side of a scan tile, the unit pairs are enumerated in
+SCREENING = False
+SCREEN_THRESHOLD = -1.0  # lag-0 Dickey-Fuller statistic above which a pair is not fully tested
+RECORD_FIELDS = ["quarter", "ticker1", "ticker2", "result", "p_value", "links"]
+SIGNIFICANCE_FIELDS = ["quarter", "interval", "linked_pairs", "linked_rate", "linked_low", "linked_high",
+                       "random_pairs", "random_rate", "random_low", "random_high", "p_value", "resamples"]
+SIGNIFICANCE_RESAMPLES = 10000
+SIGNIFICANCE_CONFIDENCE = 0.95
+SIGNIFICANCE_CHUNK = 500  # resamples per task, fixed so results do not depend on the number of workers
+SQRTEPS = np.sqrt(np.finfo(float).eps)
+CALENDAR_COVERAGE = 0.5
+CALENDAR = None
+PANEL = None
+RESULTS = {}
+PROFILE = False
+TIMINGS = {}
+COUNTERS = {}
+NULL_STAGE = nullcontext()
 #endregion
 
 
@@ -80,6 +349,89 @@ def pop_cache(cache_path):
 #endregion
 
 
+#region Profiling
+def stage(name):
+    """
+    Times a block of code as a named stage when profiling is enabled
+
+    When PROFILE is off a shared no-op context manager is returned, so an
+    instrumented block costs one function call. Stages may nest, in which
+    case the outer stage includes the inner one. Stages run inside worker
+    processes are not collected, only the parent's cointegrate stage
+
+    Globals:
+    PROFILE (bool): Whether profiling is enabled
+    TIMINGS (dictionary): Stage name to (calls, seconds)
+
+    Parameters:
+    name (string): Stage name
+
+    Returns:
+    context (context manager): Timer for the block
+    """
+
+    if not PROFILE:
+        return NULL_STAGE
+
+    return _timed(name)
+
+
+@contextmanager
+def _timed(name):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        calls, seconds = TIMINGS.get(name, (0, 0.0))
+        TIMINGS[name] = (calls + 1, seconds + perf_counter() - start)
+
+
+def count(name, amount=1):
+    """
+    Adds to a named counter when profiling is enabled
+
+    Globals:
+    PROFILE (bool): Whether profiling is enabled
+    COUNTERS (dictionary): Counter name to value
+
+    Parameters:
+    name (string): Counter name
+    amount (int, default: 1): Amount to add
+    """
+
+    if PROFILE:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+
+def profile_summary(quarter):
+    """
+    Writes the stage timings and counters collected since the last summary
+    to stderr, slowest stage first, and resets them
+
+    Globals:
+    PROFILE (bool): Whether profiling is enabled
+    TIMINGS (dictionary): Stage name to (calls, seconds)
+    COUNTERS (dictionary): Counter name to value
+
+    Parameters:
+    quarter (string): Quarter the summary is for
+    """
+
+    if not PROFILE:
+        return
+
+    lines = ["Profile for {}".format(quarter)]
+    for name, (calls, seconds) in sorted(TIMINGS.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append("  {:<24} {:>10.3f}s {:>10} calls".format(name, seconds, calls))
+    for name, value in sorted(COUNTERS.items()):
+        lines.append("  {:<24} {:>10}".format(name, value))
+    sys.stderr.write("\n".join(lines) + "\n")
+
+    TIMINGS.clear()
+    COUNTERS.clear()
+#endregion
+
+
 #region Ontology
 def populate():
     """
@@ -95,7 +447,8 @@ def populate():
     graph = Graph()
 
     for nt in glob("data/{}/*.nt".format(QUARTER)):
-        graph.parse(nt, format="nt")
+        with stage("rdflib_parse"):
+            graph.parse(nt, format="nt")
 
     return graph
 
@@ -114,53 +467,276 @@ def query(graph, type):
     ontology otherwise
     """
 
-    if type == employee_type.DIRECTOR:
-        query = graph.query(
-            '''
-            SELECT ?person ?p ?t1 ?t2
-            WHERE { {
-                ?person <http://york.ac.uk/worksat> ?company .
-                ?person <http://york.ac.uk/isdirector>  true .
-                ?person <http://york.ac.uk/worksat> ?othercompany .
-                ?person <http://xmlns.com/foaf/0.1/name> ?p .
-                ?company <http://york.ac.uk/tradingsymbol> ?t1 .
-                ?othercompany <http://york.ac.uk/tradingsymbol> ?t2 .
-                ?quarter <http://york.ac.uk/periodreport> ?q .
-                FILTER(?t1 != ?t2)
-                } }
-            ''')
-    elif type == employee_type.EMPLOYEE:
-        query = graph.query(
-            '''
-            SELECT ?person ?p ?t1 ?t2
-            WHERE { {
-                ?person <http://york.ac.uk/worksat> ?company .
-                ?person <http://york.ac.uk/worksat> ?othercompany .
-                ?person <http://xmlns.com/foaf/0.1/name> ?p .
-                ?company <http://york.ac.uk/tradingsymbol> ?t1 .
-                ?othercompany <http://york.ac.uk/tradingsymbol> ?t2 .
-                FILTER(?t1 != ?t2)
-                } }
-            ''')  # returns pairs of companies and person
-    elif type == employee_type.ALL:
-        query = graph.query(
-            '''
-            SELECT ?t
-            WHERE { {
-                ?company <http://york.ac.uk/tradingsymbol> ?t .
-                } }
-            ''')  # all companies in quarter
+    with stage("sparql"):  # rows may still be evaluated lazily when iterated
+        if type == employee_type.DIRECTOR:
+            query = graph.query(
+                '''
+                SELECT ?person ?p ?t1 ?t2
+                WHERE { {
+                    ?person <http://york.ac.uk/worksat> ?company .
+                    ?person <http://york.ac.uk/isdirector>  true .
+                    ?person <http://york.ac.uk/worksat> ?othercompany .
+                    ?person <http://xmlns.com/foaf/0.1/name> ?p .
+                    ?company <http://york.ac.uk/tradingsymbol> ?t1 .
+                    ?othercompany <http://york.ac.uk/tradingsymbol> ?t2 .
+                    ?quarter <http://york.ac.uk/periodreport> ?q .
+                    FILTER(?t1 != ?t2)
+                    } }
+                ''')
+        elif type == employee_type.EMPLOYEE:
+            query = graph.query(
+                '''
+                SELECT ?person ?p ?t1 ?t2
+                WHERE { {
+                    ?person <http://york.ac.uk/worksat> ?company .
+                    ?person <http://york.ac.uk/worksat> ?othercompany .
+                    ?person <http://xmlns.com/foaf/0.1/name> ?p .
+                    ?company <http://york.ac.uk/tradingsymbol> ?t1 .
+                    ?othercompany <http://york.ac.uk/tradingsymbol> ?t2 .
+                    FILTER(?t1 != ?t2)
+                    } }
+                ''')  # returns pairs of companies and person
+        elif type == employee_type.ALL:
+            query = graph.query(
+                '''
+                SELECT ?t
+                WHERE { {
+                    ?company <http://york.ac.uk/tradingsymbol> ?t .
+                    } }
+                ''')  # all companies in quarter
 
     return query
+
+
+def extract(graph):
+    """
+    Extracts the edges used by the experiments from an rdflib Graph: who works
+    at which ticker, their names, who is a director, and every ticker
+
+    Parameters:
+    graph (rdflib.Graph): Graph of ontology
+
+    Returns:
+    ontology (Ontology): Extracted edges
+    """
+
+    symbols = {}
+    for company, _, ticker in graph.triples((None, TRADINGSYMBOL, None)):
+        symbols.setdefault(company, []).append(str(ticker))
+
+    employment = {}
+    for person, _, company in graph.triples((None, WORKSAT, None)):
+        employment.setdefault(str(person), set()).update(symbols.get(company, []))
+
+    names = {}
+    for person, _, name in graph.triples((None, NAME, None)):
+        names.setdefault(str(person), set()).add(str(name))
+
+    directors = {str(person) for person, _, _ in graph.triples((None, ISDIRECTOR, Literal(True)))}
+    has_period = next(graph.triples((None, PERIODREPORT, None)), None) is not None
+
+    return Ontology({person: sorted(people) for person, people in names.items()},
+                    {person: sorted(tickers) for person, tickers in employment.items()},
+                    directors, [ticker for tickers in symbols.values() for ticker in tickers],
+                    has_period)
+
+
+def ontology_digest(files):
+    """
+    Hashes the names and contents of the N-Triples files for a quarter
+
+    Parameters:
+    files (list): Paths to .nt files
+
+    Returns:
+    digest (string): SHA-256 hex digest
+    """
+
+    digest = sha256()
+
+    for nt in sorted(files):
+        digest.update(path.basename(nt).encode())
+        with open(nt, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_ontology():
+    """
+    Loads the extracted ontology for a quarter, parsing the N-Triples files
+    only if they have changed since the cache was written
+
+    Globals:
+    QUARTER (string): Folder containing .nt files
+    ONTOLOGY_CACHE (string): Cache path, formatted with the quarter
+
+    Returns:
+    ontology (Ontology): Extracted edges for quarter
+    """
+
+    digest = ontology_digest(glob("data/{}/*.nt".format(QUARTER)))
+    cache_path = ONTOLOGY_CACHE.format(QUARTER)
+
+    if path.isfile(cache_path):
+        try:
+            with stage("ontology_cache"), open(cache_path) as infile:
+                cached = json.load(infile)
+            cached_digest, fields = cached["digest"], cached["ontology"]
+        except:
+            cached_digest = None
+        if cached_digest == digest:
+            return Ontology(fields["names"], fields["employment"], set(fields["directors"]),
+                            fields["tickers"], fields["has_period"])
+
+    graph = populate()
+    with stage("ontology_extract"):
+        ontology = extract(graph)
+
+    makedirs(path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + ".tmp", "w") as outfile:  # JSON rather than pickle, so reading it cannot run code
+        json.dump({"digest": digest, "ontology": dict(vars(ontology), directors=sorted(ontology.directors))}, outfile)
+    replace(cache_path + ".tmp", cache_path)
+
+    return ontology
 #endregion
 
 
 #region Stock
+def download(source, ticker, directory, start, end, retries=None, backoff=None):
+    """
+    Downloads a ticker into the stock cache, retrying with exponential
+    backoff. A negative cache entry is recorded only when every attempt
+    reached the source and it answered that it has no prices for the ticker,
+    raising ValueError; after any other failure, e.g. a network error, the
+    ticker is tried again by the next run
+
+    Parameters:
+    source (YahooSource or DirectorySource): Source of price data
+    ticker (string): Stock ticker
+    directory (string): Stock cache directory for the quarter
+    start (datetime): Start of period to retrieve stock information for
+    end (datetime): End of period to retrieve stock information for
+    retries (int, default: None): Number of attempts, DOWNLOAD_RETRIES if
+    None
+    backoff (float, default: None): Seconds to wait after the first failure,
+    doubled after each further failure, DOWNLOAD_BACKOFF if None
+
+    Returns:
+    downloaded (bool): Whether the ticker was cached
+    """
+
+    retries = DOWNLOAD_RETRIES if retries is None else retries
+    backoff = DOWNLOAD_BACKOFF if backoff is None else backoff
+
+    unreachable = False
+
+    for attempt in range(retries):
+        try:
+            series = source.fetch(ticker, start, end)
+        except ValueError:
+            pass
+        except:
+            unreachable = True  # later attempts can fail differently, e.g. yfinance caching a missing timezone
+        else:
+            series.to_csv(path.join(directory, "{}.csv".format(ticker)), index=False)
+            return True
+
+        if attempt < retries - 1:
+            sleep(backoff * 2 ** attempt)
+
+    if not unreachable:
+        open(path.join(directory, "{}.missing".format(ticker)), "w").close()
+
+    return False
+
+
+def is_missing(directory, ticker):
+    """
+    Checks for a negative cache entry younger than MISSING_TTL, so tickers
+    the source had no prices for are retried once it has expired
+
+    Globals:
+    MISSING_TTL (float): Seconds a negative cache entry is kept
+
+    Parameters:
+    directory (string): Stock cache directory for the quarter
+    ticker (string): Stock ticker
+
+    Returns:
+    missing (bool): Whether the ticker is recorded as having no prices
+    """
+
+    marker = path.join(directory, "{}.missing".format(ticker))
+
+    return path.isfile(marker) and time() - path.getmtime(marker) < MISSING_TTL
+
+
+def prefetch(tickers, source=None, workers=None, quarter=None):
+    """
+    Downloads every ticker not yet cached for the quarter through a bounded
+    thread pool, so that a quarter run never waits on the network inside the
+    cointegration loop
+
+    Tickers the source had no prices for are skipped until their .missing
+    file is MISSING_TTL old; delete it to retry them sooner
+
+    Globals:
+    QUARTER (string): The quarter to cache prices for
+    COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
+    information for
+    COINTEGRATION_END_DATE (datetime): End of period to retrieve stock
+    information for
+    DATA_SOURCE (YahooSource or DirectorySource): Default source of prices
+
+    Parameters:
+    tickers (iterable): Stock tickers
+    source (YahooSource or DirectorySource, default: None): Source of price
+    data, DATA_SOURCE if None
+    workers (int, default: None): Number of download threads,
+    DOWNLOAD_WORKERS if None
+    quarter (Quarter, default: None): Quarter to cache prices for instead of
+    the globals
+
+    Returns:
+    failed (set): Tickers that could not be downloaded
+    """
+
+    source = DATA_SOURCE if source is None else source
+    workers = DOWNLOAD_WORKERS if workers is None else workers
+    directory = "stocks/{}".format(QUARTER if quarter is None else quarter.folder)
+    makedirs(directory, exist_ok=True)
+
+    pending = [ticker for ticker in dict.fromkeys(tickers)
+               if not path.isfile(path.join(directory, "{}.csv".format(ticker)))
+               and not is_missing(directory, ticker)]
+    if not pending:
+        return set()
+
+    if quarter is None:
+        start, end = COINTEGRATION_START_DATE, COINTEGRATION_END_DATE
+    else:
+        start, end = quarter.start, quarter.end
+    with stage("download"), ThreadPoolExecutor(max_workers=workers) as executor:
+        downloaded = list(executor.map(
+            lambda ticker: download(source, ticker, directory, start, end), pending))
+
+    failed = {ticker for ticker, success in zip(pending, downloaded) if not success}
+    count("downloaded", len(pending) - len(failed))
+    count("download_failed", len(failed))
+
+    return failed
+
+
 def fetch_ticker(ticker):
     """
     Retrieves historical stock data between specified start and end dates
     using close of day price
 
+    Reads from the stock cache, downloading the ticker first if it has not
+    been cached or recorded as failed
+
     Globals:
     COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
     information for
@@ -171,20 +747,21 @@ def fetch_ticker(ticker):
     ticker (string): Stock ticker
 
     Returns:
-    series (pandas.DataFrame): DataFrame with data between dates
+    series (pandas.DataFrame): DataFrame with data between dates, None if
+    the ticker could not be downloaded
     """
 
     directory = "stocks/{}/{}.csv".format(QUARTER, ticker)
-    if path.isfile(directory):
-        series = pd.read_csv(directory)
-        series["Date"] = series["Date"].apply(pd.to_datetime)
-    else:
-        try:
-            series = yf.download(ticker, start=COINTEGRATION_START_DATE, end=COINTEGRATION_END_DATE,
-                                 threads=False).filter(["Date", "Close"]).reset_index(drop=False)
-            series.to_csv(directory, index=False)
-        except:
-            return None
+    if not path.isfile(directory) and prefetch([ticker], workers=1):
+        return None
+
+    try:
+        with stage("csv_read"):
+            series = pd.read_csv(directory)
+            series["Date"] = pd.to_datetime(series["Date"])
+    except:
+        return None
+
     return series
 
 
@@ -192,14 +769,17 @@ def cointegrate(ticker1, ticker2):
     """
     Cointegrates two time series
 
-    Methods to eliminate erroneous pairs are missing trading days, null values
-    in one column but not the other
+    Single-pair form of cointegrate_batch(), sharing its array-based decision.
+    Prices are sliced from the quarter's PricePanel rather than read from disk
+    per pair. Methods to eliminate erroneous pairs are missing trading days,
+    null values in one column but not the other
 
     Cointegration methodology is Engle-Granger p-value < 0.05 and Johansen at
     95% confidence
 
     Globals:
     TRADING_DAYS (int): Amount of trading days for the quarter
+    QUARTER (string): The quarter to select the price panel for
 
     Parameters:
     ticker1 (string): First stock ticker of pair
@@ -214,37 +794,17 @@ def cointegrate(ticker1, ticker2):
     uncointegrated pair and p-value
     """
 
-    series1 = fetch_ticker(ticker1)
-    series2 = fetch_ticker(ticker2)
-
-    try:
-        merged = pd.merge(series1, series2, how="outer", on=["Date"])
-    except:
-        return (coint_return.INVALID, None)
-    merged.dropna(inplace=True)
-    merged.reset_index(inplace=True, drop=False)
-
-    if len(merged) < TRADING_DAYS:
-        return (coint_return.INVALID, None)
-
-    johansen_frame = pd.DataFrame(
-        {"x": merged["Close_x"], "y": merged["Close_y"]})
-
-    try:  # weird divide by zero error here on occassion
-        score, p_value, _ = coint(merged["Close_x"], merged["Close_y"])
-        johansen = coint_johansen(johansen_frame, 0, 1)
-    except:
-        return (coint_return.INVALID, None)
-
-    if p_value < 0.05 and johansen.cvt[0][1] < johansen.lr1[0]: # calculates cointegration using p-value and trace statistic (95% confidence)
-        return (coint_return.RELATIONSHIP, p_value)
-    return (coint_return.NO_RELATIONSHIP, p_value)
+    return cointegrate_batch([(ticker1, ticker2)])[0]
 
 
+@lru_cache(maxsize=CLEAN_CACHE_SIZE)
 def clean(ticker):
     """
     Sanitises ticker, removing common erronous symbols
 
+    Special cases are applied from TICKER_REPLACEMENTS in order, and results
+    are memoised since the same tickers recur on every row
+
     Parameters:
     ticker (string): Stock ticker according to ontology
 
@@ -252,392 +812,3023 @@ def clean(ticker):
     ticker (string): Sanitised stock ticker
     """
 
-    replace_with_blank = ["NASDAQ", "NYSE", "*", ":",
-                          "/", " ", "[", "]", '"']  # manual filtering
-    ticker = ticker.replace(".", "-") # todo: replace this with an actual dictionary of replacements
-    ticker = ticker.replace("CRDA CRDB", "CRDA")
-    ticker = ticker.replace("CRDA-CRDB", "CRDB")
-    ticker = ticker.replace('FCE-A/FCEB', "FCEA")
-    ticker = ticker.replace('FCEA/FCEB', "FCEB")
-    ticker = ticker.replace('BFA, BFB', "BFB")
-    for symbol in replace_with_blank:
-        ticker = ticker.replace(symbol, "")
+    ticker = ticker.replace(".", "-")
+    for old, new in TICKER_REPLACEMENTS.items():
+        ticker = ticker.replace(old, new)
+    for exchange in TICKER_EXCHANGES:  # manual filtering
+        ticker = ticker.replace(exchange, "")
 
-    return ticker
-#endregion
+    return ticker.translate(TICKER_SYMBOLS)
 
 
-#region Set generation
-def pairs_with_links(query):
+def clean_series(tickers):
     """
-    Finds the number of links for each pair of companies from query
-
-    Should only be used for employee_type.DIRECTOR or employee_type.EMPLOYEE
+    Sanitises a whole column of tickers at once, equivalent to applying
+    clean() to each
 
     Parameters:
-    query (list): List of tuples in format (SEC report URL, name, ticker1,
-    ticker2)
+    tickers (iterable): Stock tickers according to ontology
 
     Returns:
-    sorted_pairs (dictionary): Dictionary of pair (key) and number of links
-    (value)
+    tickers (pandas.Series): Sanitised stock tickers
     """
 
-    pair_people_out = {}
-    remove_keys = set()
+    tickers = pd.Series(list(tickers), dtype=object).astype(str)
+    tickers = tickers.str.replace(".", "-", regex=False)
+    for old, new in TICKER_REPLACEMENTS.items():
+        tickers = tickers.str.replace(old, new, regex=False)
+    for exchange in TICKER_EXCHANGES:
+        tickers = tickers.str.replace(exchange, "", regex=False)
 
-    for row in query:
-        sec_report, person, ticker1, ticker2 = row
-        ticker1, ticker2 = clean(str(ticker1).upper()), clean(str(ticker2).upper())
-        pair = (ticker1, ticker2)
+    return tickers.str.translate(TICKER_SYMBOLS)
+#endregion
 
-        if pair in pair_people_out:
-            pair_people_out[pair].append(person)
-        else:
-            pair_people_out[pair] = [person]
 
-    for key in pair_people_out:
-        key_reversed = (key[1], key[0])
+#region Price panel
+class PricePanel:
+    def __init__(self, quarter, calendar=None):
+        self.quarter = quarter
+        self.calendar = calendar
+        self.dates = pd.DatetimeIndex([] if calendar is None else calendar, name="Date")
+        self.tickers = []
+        self.columns = {}
+        self.prices = np.empty((len(self.dates), 0))
+        self.missing = set()
+        self.bits = None
+        self.restore()
+
+    def restore(self):
+        """
+        Opens the quarter's binary store, if one exists, as a read-only
+        memory map so that loading it copies nothing
+
+        A store written with other dates than the panel's calendar is
+        realigned to the calendar and rewritten
+
+        Globals:
+        PANEL_STORE (string): Path of the price matrix, formatted with the
+        quarter
+        PANEL_INDEX (string): Path of the date and ticker index, formatted
+        with the quarter
+        """
+
+        store, index = PANEL_STORE.format(self.quarter), PANEL_INDEX.format(self.quarter)
+        if not path.isfile(store) or not path.isfile(index):
+            return
+
+        with open(index) as infile:
+            fields = json.load(infile)
+        prices = np.load(store, mmap_mode="r")
+
+        if prices.shape != (len(fields["dates"]), len(fields["tickers"])):  # interrupted save
+            return
+
+        dates = pd.DatetimeIndex(pd.to_datetime(fields["dates"]), name="Date")
+        self.tickers = fields["tickers"]
+        self.columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.bits = None
+
+        if self.calendar is None or dates.equals(self.dates):
+            self.dates = dates
+            self.prices = prices
+            return
+
+        self.prices = self.align(dates, prices)
+        self.save()
+
+    def align(self, dates, values):
+        """
+        Places values observed on the given dates onto the rows of the
+        panel's calendar by integer date index, dropping dates that are not
+        trading days
+
+        Parameters:
+        dates (pandas.DatetimeIndex): Date of each row of values
+        values (numpy.ndarray): Array of dates x tickers
+
+        Returns:
+        aligned (numpy.ndarray): Array of calendar days x tickers, NaN where
+        a ticker has no value
+        """
+
+        rows = self.dates.get_indexer(dates)
+        kept = rows >= 0
+        aligned = np.full((len(self.dates), values.shape[1]), np.nan)
+        aligned[rows[kept]] = values[kept]
+
+        return aligned
+
+    def save(self):
+        """
+        Writes the panel to the quarter's binary store, one column-major
+        float64 .npy matrix plus a JSON index of dates and tickers, and
+        reopens it memory-mapped
+        """
+
+        store, index = PANEL_STORE.format(self.quarter), PANEL_INDEX.format(self.quarter)
+        makedirs(path.dirname(store), exist_ok=True)
+
+        with open(store + ".tmp", "wb") as outfile:
+            np.save(outfile, np.asfortranarray(self.prices))  # each ticker's prices contiguous
+        with open(index + ".tmp", "w") as outfile:
+            json.dump({"dates": [date.isoformat() for date in self.dates],
+                       "tickers": self.tickers}, outfile)
+        replace(store + ".tmp", store)
+        replace(index + ".tmp", index)
+
+        self.prices = np.load(store, mmap_mode="r")
+
+    def load(self, tickers):
+        """
+        Adds any tickers not yet in the panel, reading each ticker's data once
+        per quarter and aligning it to the panel's dates: the calendar's
+        trading days if the panel has one, otherwise every date any ticker
+        traded
+
+        Uncached tickers are downloaded together by prefetch() first. Tickers
+        that fail to load are remembered so they are not retried. The binary
+        store is rewritten whenever tickers are added
+
+        Parameters:
+        tickers (iterable): Stock tickers to make available
+        """
+
+        new = {}
+        tickers = [ticker for ticker in dict.fromkeys(tickers)
+                   if ticker not in self.columns and ticker not in self.missing]
+        prefetch(tickers)
+
+        for ticker in tickers:
+            series = fetch_ticker(ticker)
+            if series is None or "Date" not in series or "Close" not in series:
+                self.missing.add(ticker)
+                continue
+
+            series = series.drop_duplicates("Date").set_index("Date")["Close"]
+            new[ticker] = pd.to_numeric(series, errors="coerce")
+
+        if not new:
+            return
+
+        with stage("panel_align"):
+            if self.calendar is not None:
+                added = np.hstack([self.align(series.index, series.to_numpy(dtype=float)[:, None])
+                                   for series in new.values()])
+                self.prices = np.hstack((np.asarray(self.prices), added))
+            else:
+                frame = pd.DataFrame(new)
+                dates = self.dates.union(frame.index)
+                existing = pd.DataFrame(self.prices, index=self.dates).reindex(dates)
+
+                self.prices = np.hstack((existing.to_numpy(dtype=float),
+                                         frame.reindex(dates).to_numpy(dtype=float)))
+                self.dates = dates
+        self.bits = None
+        for ticker in new:
+            self.columns[ticker] = len(self.tickers)
+            self.tickers.append(ticker)
+
+        with stage("panel_write"):
+            self.save()
+
+    def bitmap(self):
+        """
+        Packs which days each ticker has a price for into a bitmap, rebuilt
+        only after new tickers are loaded
+
+        Returns:
+        bits (numpy.ndarray): uint8 array of tickers x packed days
+        """
+
+        if self.bits is None:
+            self.bits = np.packbits(~np.isnan(self.prices), axis=0).T.copy()
+
+        return self.bits
+
+    def tradeable(self, tickers, days):
+        """
+        Filters tickers down to those loaded with at least the given number
+        of valid days, since no pair containing any other ticker can be valid
+
+        Parameters:
+        tickers (iterable): Stock tickers
+        days (int): Minimum number of valid days
+
+        Returns:
+        tickers (list): Tickers that can form a valid pair
+        """
+
+        coverage = POPCOUNT[self.bitmap()].sum(axis=1, dtype=np.int64)
+
+        return [ticker for ticker in tickers
+                if ticker in self.columns and coverage[self.columns[ticker]] >= days]
+
+    def overlapping(self, pairs, days):
+        """
+        Checks which pairs share enough valid days to be tested, using an AND
+        and popcount over the bitmap instead of aligning the prices
+
+        Parameters:
+        pairs (list): List of (ticker1, ticker2) pairs of loaded tickers
+        days (int): Minimum number of days both tickers must have traded
+
+        Returns:
+        valid (numpy.ndarray): Boolean per pair
+        """
 
-        if key[0] == key[1]:  # reflexive pairs
-            remove_keys.add(key)
-        elif key_reversed in pair_people_out and key not in remove_keys:  # transitive pairs
-            remove_keys.add(key_reversed)
+        if not pairs:
+            return np.zeros(0, dtype=bool)
+
+        bits = self.bitmap()
+        first = bits[[self.columns[pair[0]] for pair in pairs]]
+        second = bits[[self.columns[pair[1]] for pair in pairs]]
 
-    for key in remove_keys:
-        pair_people_out.pop(key)
+        return POPCOUNT[first & second].sum(axis=1, dtype=np.int64) >= days
 
-    for key in pair_people_out:
-        people = set(pair_people_out[key])  # remove duplicate people
-        pair_people_out[key] = len(people)  # amount of links
 
-    return {k: v for k, v in sorted(
-        pair_people_out.items(), key=lambda item: item[1], reverse=True)}  # sorts dictionary descending by number of links
+def get_panel():
+    """
+    Retrieves the price panel for the current quarter, replacing the panel of
+    any previous quarter
 
+    Globals:
+    QUARTER (string): The quarter the panel holds prices for
+    CALENDAR (pandas.DatetimeIndex): Trading days the panel is aligned to
+    PANEL (PricePanel): Panel for the most recently used quarter
 
-def generate_random_set(companies, size, exclusion_list=None):
+    Returns:
+    PANEL (PricePanel): Panel for the current quarter
     """
-    Generates a set of validated pairs by randomly selecting pairs from every
-    combination of every company in the ontology for a given quarter
 
-    Removes transitive, duplicate, erroneous, and reversed pairs.
+    global PANEL
+
+    if PANEL is None or PANEL.quarter != QUARTER:
+        PANEL = PricePanel(QUARTER, CALENDAR)
+
+    return PANEL
+
+
+def observed_calendar(panel, coverage=CALENDAR_COVERAGE):
+    """
+    Derives trading days from the prices themselves, for periods the holiday
+    table does not cover: the dates on which at least a share of the panel's
+    tickers traded
 
     Parameters:
-    companies (list): List of all pairs in ontology
-    size (int): Number of pairs to generate
-    exclusion_list (list, default: None): Pairs to ignore. Typically used to
-    remove pairs of linked companies.
+    panel (PricePanel): Panel loaded without a calendar
+    coverage (float, default: CALENDAR_COVERAGE): Share of tickers that must
+    have traded on a date
 
     Returns:
-    pair_set (list): List of validated pairs
+    dates (pandas.DatetimeIndex): Trading days
     """
 
-    count = 0
-    pair_set = set()
-    all_pairs = combinations(companies, 2)
-    pairs = [x for x in all_pairs if x not in exclusion_list]
+    traded = (~np.isnan(np.asarray(panel.prices))).sum(axis=1)
 
-    while True:
-        pair = choice(pairs)
-        reversed_pair = (pair[1], pair[0])
-        result, p_value = cointegrate(pair[0], pair[1])
+    return panel.dates[traded >= coverage * len(panel.tickers)]
 
-        if pair[0] == pair[1] or pair in pair_set or result == coint_return.INVALID or reversed_pair in pair_set:
-            count -= 1
-        else:
-            pair_set.add(pair)
 
-        count += 1
+def get_quarter(name, tickers=None):
+    """
+    Creates a Quarter from its name, e.g. "2018Q3", with its trading days
+    from the NYSE holiday table, or from observed_calendar() for years the
+    table does not cover
 
-        if count >= size:
-            break
+    For an observed calendar, the quarter's tickers are loaded into a panel
+    without a calendar first, downloading any that are not cached
 
-    return pair_set
+    Globals:
+    CALENDAR_COVERAGE (float): Share of tickers that must have traded on a
+    date observed as a trading day
+
+    Parameters:
+    name (string): Year and quarter number
+    tickers (iterable, default: None): Tickers to observe trading days from,
+    every company in the quarter's ontology if None
+
+    Returns:
+    quarter (Quarter): Quarter with its trading days
+
+    Raises:
+    ValueError: If the name is not a quarter
+    """
+
+    provisional = NYSE.quarter(name, dates=[])  # only the name, start and end
+    if NYSE.covers(provisional.start, provisional.end):
+        return NYSE.quarter(name)
+
+    set_quarter(provisional)
+    if tickers is None:
+        tickers = clean_series(str(row[0]).upper() for row in load_ontology().query(employee_type.ALL))
+
+    panel = PricePanel(name)
+    panel.load(tickers)
+
+    return NYSE.quarter(name, dates=observed_calendar(panel, CALENDAR_COVERAGE))
+#endregion
+
+
+#region Cointegration
+def aligned_pairs(prices, pairs):
+    """
+    Groups pairs by the number of days both tickers traded, dropping the days
+    where either is missing (equivalent to merging and calling dropna)
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+
+    Returns:
+    groups (generator): Tuples of (rows, x, y) where rows indexes into pairs
+    and x, y are aligned price arrays of shape (len(rows), days)
+    """
+
+    x = prices[:, pairs[:, 0]].T
+    y = prices[:, pairs[:, 1]].T
+    valid = ~(np.isnan(x) | np.isnan(y))
+    days = valid.sum(axis=1)
+
+    for n in np.unique(days):
+        rows = np.flatnonzero(days == n)
+        mask = valid[rows]
+        yield rows, x[rows][mask].reshape(len(rows), n), y[rows][mask].reshape(len(rows), n)
+
+
+def mackinnon_p(stats, n=2):
+    """
+    Vectorised MacKinnon (1994) approximate p-values for Engle-Granger
+    statistics with a constant, as used by statsmodels.tsa.stattools.coint
+
+    Evaluates statsmodels' coefficient tables directly when they agree with
+    its public mackinnonp(), otherwise calls mackinnonp() per statistic
+
+    Globals:
+    MACKINNON_TABLES (bool): Whether the coefficient tables can be used
+
+    Parameters:
+    stats (numpy.ndarray): Test statistics
+    n (int, default: 2): Number of series in the cointegrating regression
+
+    Returns:
+    p_values (numpy.ndarray): Approximate p-values, NaN where stats is NaN
+    """
+
+    stats = np.asarray(stats, dtype=float)
+
+    if not MACKINNON_TABLES:
+        return np.array([np.nan if np.isnan(stat) else mackinnonp(stat, "c", n)
+                         for stat in stats.ravel()], dtype=float).reshape(stats.shape)
+
+    small = np.asarray(_tau_smallps["c"][n - 1])[::-1]
+    large = np.asarray(_tau_largeps["c"][n - 1])[::-1]
+
+    with np.errstate(invalid="ignore", over="ignore"):
+        p_values = norm.cdf(np.where(stats <= _tau_stars["c"][n - 1],
+                                     np.polyval(small, stats), np.polyval(large, stats)))
+    p_values[stats > _tau_maxs["c"][n - 1]] = 1.0
+    p_values[stats < _tau_mins["c"][n - 1]] = 0.0
+    p_values[np.isnan(stats)] = np.nan
+
+    return p_values
+
+
+MACKINNON_TABLES = _tau_maxs is not None
+if MACKINNON_TABLES:  # fall back to mackinnonp() if a statsmodels upgrade changes the private tables
+    try:
+        MACKINNON_GRID = np.linspace(-25, 5, 301)
+        MACKINNON_TABLES = np.allclose(mackinnon_p(MACKINNON_GRID),
+                                       [mackinnonp(stat, "c", 2) for stat in MACKINNON_GRID], rtol=0, atol=1e-12)
+    except (KeyError, IndexError, TypeError, ValueError):
+        MACKINNON_TABLES = False
+
+
+def _adf_design(level, diff, lags, nobs):
+    """
+    Builds the stacked ADF regressors: lagged level followed by lagged
+    differences, trimmed to the last nobs observations
+    """
+
+    start = level.shape[1] - 1 - nobs
+    columns = [level[:, start:-1]]
+    columns += [diff[:, start - k:diff.shape[1] - k] for k in range(1, lags + 1)]
+
+    return np.stack(columns, axis=2)
+
+
+def _adf_statistic(resid):
+    """
+    Stacked ADF t-statistics without constant or trend, choosing the lag
+    length by AIC as statsmodels.tsa.stattools.adfuller(autolag="aic") does
+
+    Parameters:
+    resid (numpy.ndarray): Residual series of shape (pairs, days)
+
+    Returns:
+    stats (numpy.ndarray): ADF statistic per row, NaN if too short
+    """
+
+    count, n = resid.shape
+    stats = np.full(count, np.nan)
+    maxlag = min(n // 2 - 1, int(np.ceil(12.0 * np.power(n / 100.0, 1 / 4.0))))
+    nobs = n - 1 - maxlag
+
+    if maxlag < 0 or nobs <= maxlag + 1 or count == 0:
+        return stats
+
+    diff = np.diff(resid, axis=1)
+
+    # nested least squares: the first k columns of Q span the first k regressors
+    q, _ = np.linalg.qr(_adf_design(resid, diff, maxlag, nobs))
+    target = diff[:, -nobs:]
+    projected = np.einsum("bnk,bn->bk", q, target)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ssr = (target ** 2).sum(axis=1)[:, None] - np.cumsum(projected ** 2, axis=1)
+        aic = nobs * np.log(ssr) + 2 * np.arange(1, maxlag + 2)
+    bestlag = np.argmin(aic, axis=1)
+
+    for lag in np.unique(bestlag):
+        rows = np.flatnonzero(bestlag == lag)
+        lag_nobs = n - 1 - lag
+        target = diff[rows][:, -lag_nobs:]
+        q, r = np.linalg.qr(_adf_design(resid[rows], diff[rows], lag, lag_nobs))
+        projected = np.einsum("bnk,bn->bk", q, target)
+        singular = np.any(np.diagonal(r, axis1=1, axis2=2) == 0, axis=1)
+        r[singular] = np.eye(lag + 1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r_inv = np.linalg.inv(r)
+            coef = np.einsum("bk,bk->b", r_inv[:, 0, :], projected)
+            ssr = (target ** 2).sum(axis=1) - (projected ** 2).sum(axis=1)
+            variance = ssr / (lag_nobs - lag - 1) * (r_inv[:, 0, :] ** 2).sum(axis=1)
+            stats[rows] = np.where(singular, np.nan, coef / np.sqrt(variance))
+
+    return stats
+
+
+def engle_granger(prices, pairs):
+    """
+    Batch Engle-Granger test, matching statsmodels.tsa.stattools.coint with
+    its defaults (constant, AIC lag selection) for every pair at once
+
+    The first ticker of each pair is regressed on the second, as in
+    cointegrate()
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+
+    Returns:
+    stats (numpy.ndarray): Test statistic per pair, NaN where the test
+    cannot be computed
+    p_values (numpy.ndarray): MacKinnon p-value per pair
+    """
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    stats = np.full(len(pairs), np.nan)
+
+    for rows, y0, y1 in aligned_pairs(prices, pairs):
+        resid, colinear, constant = _cointegrating_residuals(y0, y1)
+
+        group = _adf_statistic(resid)
+        group[colinear] = -np.inf
+        group[constant] = np.nan
+        stats[rows] = group
+
+    return stats, mackinnon_p(stats)
+
+
+def _cointegrating_residuals(y0, y1):
+    """
+    Residuals of the stacked regressions of y0 on y1 with a constant, with
+    masks of (almost) perfectly colinear pairs and constant price series
+    """
+
+    d0 = y0 - y0.mean(axis=1, keepdims=True)
+    d1 = y1 - y1.mean(axis=1, keepdims=True)
+    s00 = (d0 * d0).sum(axis=1)
+    s11 = (d1 * d1).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = np.where(s11 > 0, (d0 * d1).sum(axis=1) / s11, 0.0)
+        resid = d0 - beta[:, None] * d1
+        rsquared = 1 - (resid * resid).sum(axis=1) / s00
+
+    return resid, rsquared >= 1 - 100 * SQRTEPS, (s00 == 0) | (s11 == 0)
+
+
+def screen_statistic(prices, pairs):
+    """
+    Cheap pre-screen for engle_granger(): the Dickey-Fuller statistic of the
+    same regression residuals with no lagged differences, so no lag search
+    and no QR decompositions
+
+    A pair whose statistic is well above the Engle-Granger critical value is
+    very unlikely to pass the full test. How far above is safe is set by
+    SCREEN_THRESHOLD and checked with screen_report()
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+
+    Returns:
+    stats (numpy.ndarray): Statistic per pair, NaN where it cannot be
+    computed and -inf for (almost) perfectly colinear pairs
+    """
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    stats = np.full(len(pairs), np.nan)
+
+    for rows, y0, y1 in aligned_pairs(prices, pairs):
+        resid, colinear, constant = _cointegrating_residuals(y0, y1)
+        lagged, diff = resid[:, :-1], np.diff(resid, axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sxx = (lagged * lagged).sum(axis=1)
+            rho = (lagged * diff).sum(axis=1) / sxx
+            ssr = ((diff - rho[:, None] * lagged) ** 2).sum(axis=1)
+            group = rho / np.sqrt(ssr / (diff.shape[1] - 1) / sxx)
+
+        group[colinear] = -np.inf
+        group[constant] = np.nan
+        stats[rows] = group
+
+    return stats
+
+
+def _inverse2(a):
+    """
+    Inverts stacked 2x2 matrices in closed form, giving inf/NaN rather than
+    raising for singular matrices
+    """
+
+    det = a[..., 0, 0] * a[..., 1, 1] - a[..., 0, 1] * a[..., 1, 0]
+    inverse = np.empty_like(a)
+    inverse[..., 0, 0] = a[..., 1, 1]
+    inverse[..., 1, 1] = a[..., 0, 0]
+    inverse[..., 0, 1] = -a[..., 0, 1]
+    inverse[..., 1, 0] = -a[..., 1, 0]
+
+    return inverse / det[..., None, None]
+
+
+def _johansen_trace_statistic(levels):
+    """
+    Stacked bivariate Johansen trace statistic for r = 0, equal to
+    coint_johansen(levels, 0, 1).lr1[0]
+
+    Parameters:
+    levels (numpy.ndarray): Price levels of shape (pairs, days, 2)
+
+    Returns:
+    trace (numpy.ndarray): Trace statistic per pair
+    """
+
+    def demean(a):
+        return a - a.mean(axis=1, keepdims=True)
+
+    def residual(a, z, zz_inverse):
+        return a - z @ (zz_inverse @ (z.transpose(0, 2, 1) @ a))
+
+    diff = np.diff(levels, axis=1)
+    lagged = demean(diff[:, :-1])
+    current = demean(diff[:, 1:])
+    level = demean(levels[:, 1:-1])
+    t = level.shape[1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zz_inverse = _inverse2(lagged.transpose(0, 2, 1) @ lagged)
+        r0t = residual(current, lagged, zz_inverse)
+        rkt = residual(level, lagged, zz_inverse)
+
+        skk = rkt.transpose(0, 2, 1) @ rkt / t
+        sk0 = rkt.transpose(0, 2, 1) @ r0t / t
+        s00 = r0t.transpose(0, 2, 1) @ r0t / t
+        sig = sk0 @ _inverse2(s00) @ sk0.transpose(0, 2, 1)
+
+        # sum(log(1 - eigenvalues of skk^-1 sig)) without an eigendecomposition
+        det_skk = skk[:, 0, 0] * skk[:, 1, 1] - skk[:, 0, 1] * skk[:, 1, 0]
+        rest = skk - sig
+        det_rest = rest[:, 0, 0] * rest[:, 1, 1] - rest[:, 0, 1] * rest[:, 1, 0]
+        trace = -t * np.log(det_rest / det_skk)
+
+    trace[~np.isfinite(trace)] = np.nan
+
+    return trace
+
+
+def johansen_trace(prices, pairs, mask=None):
+    """
+    Batch bivariate Johansen trace test (constant term, one lagged
+    difference), matching coint_johansen(frame, 0, 1)
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+    mask (numpy.ndarray, default: None): Boolean array selecting the pairs to
+    test, e.g. those passing the Engle-Granger p-value gate. All pairs are
+    tested if None
+
+    Returns:
+    trace (numpy.ndarray): lr1[0] per pair, NaN where untested or failed
+    critical (numpy.ndarray): 95% critical value cvt[0][1] per pair, NaN
+    where untested
+    """
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    selected = np.arange(len(pairs)) if mask is None else np.flatnonzero(mask)
+    trace = np.full(len(pairs), np.nan)
+    critical = np.full(len(pairs), np.nan)
+
+    for rows, y0, y1 in aligned_pairs(prices, pairs[selected]):
+        rows = selected[rows]
+        critical[rows] = c_sjt(2, 0)[1]
+        if y0.shape[1] > 3:
+            trace[rows] = _johansen_trace_statistic(np.stack((y0, y1), axis=2))
+
+    return trace, critical
+
+
+def evaluate_pairs(prices, pairs, days, screen=None):
+    """
+    Cointegrates a batch of pairs, applying the same validity rules and
+    decision as cointegrate()
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+    days (int): Minimum number of days both tickers must have traded
+    screen (float, default: None): Pairs whose screen_statistic() is above
+    this are NO_RELATIONSHIP without being fully tested, None to test all
+
+    Returns:
+    results (numpy.ndarray): coint_return value per pair
+    p_values (numpy.ndarray): Engle-Granger p-value per pair, NaN if invalid
+    or screened out
+    """
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    results = np.full(len(pairs), coint_return.INVALID.value, dtype=np.int8)
+    p_values = np.full(len(pairs), np.nan)
+
+    valid = ~(np.isnan(prices[:, pairs[:, 0]]) | np.isnan(prices[:, pairs[:, 1]]))
+    tested = np.flatnonzero(valid.sum(axis=0) >= days)
+    screened = tested[:0]
+
+    if screen is not None:
+        with stage("screen"), np.errstate(invalid="ignore"):
+            rejected = screen_statistic(prices, pairs[tested]) > screen  # NaN goes on to the full test
+        screened, tested = tested[rejected], tested[~rejected]
+
+    with stage("engle_granger"):
+        _, p_values[tested] = engle_granger(prices, pairs[tested])
+
+    with np.errstate(invalid="ignore"):
+        gate = p_values < 0.05  # Johansen is only needed for pairs passing Engle-Granger
+    with stage("johansen"):
+        trace, critical = johansen_trace(prices, pairs, mask=gate)
+    p_values[gate & np.isnan(trace)] = np.nan
+
+    results[~np.isnan(p_values)] = coint_return.NO_RELATIONSHIP.value
+    results[screened] = coint_return.NO_RELATIONSHIP.value
+    with np.errstate(invalid="ignore"):
+        results[gate & (critical < trace)] = coint_return.RELATIONSHIP.value
+
+    return results, p_values
+
+
+def cointegrate_batch(pairs):
+    """
+    Cointegrates a batch of pairs in one pass over the quarter's price panel
+
+    Results are kept in RESULTS keyed by (quarter, ticker1, ticker2), so a
+    pair is only tested once per quarter however many sets or stages
+    request it. The quarter is part of the key because the same pair is
+    re-tested in each following quarter by sliding_existing(), and the
+    ticker order is kept because the regression is not symmetric
+
+    Globals:
+    TRADING_DAYS (int): Amount of trading days for the quarter
+    QUARTER (string): The quarter to select the price panel for
+    RESULTS (dictionary): Store of (coint_return, p_value) tuples
+    WORKERS (int): Number of worker processes, passed to evaluate_parallel()
+    SCREENING (bool): Whether to pre-screen pairs at SCREEN_THRESHOLD
+    CHECKPOINTING (bool): Whether to checkpoint the quarter's results after
+    every CHECKPOINT_INTERVAL pairs, otherwise every pair is evaluated in
+    one evaluate_parallel() call
+
+    Parameters:
+    pairs (list): List of (ticker1, ticker2) pairs
+
+    Returns:
+    results (list): List of (coint_return, p_value) tuples in the same order
+    as pairs, as returned by cointegrate()
+    """
+
+    keys = [(QUARTER, pair[0], pair[1]) for pair in pairs]
+    untested = list(dict.fromkeys(key for key in keys if key not in RESULTS))
+    count("cached", len(keys) - len(untested))
+
+    if untested:
+        panel = get_panel()
+        panel.load(ticker for key in untested for ticker in key[1:])
+
+        known = [key for key in untested
+                 if key[1] in panel.columns and key[2] in panel.columns]
+        unknown = [key for key in untested
+                   if key[1] not in panel.columns or key[2] not in panel.columns]
+        if PROFILE:
+            count_unloaded(panel, unknown)
+
+        step = CHECKPOINT_INTERVAL if CHECKPOINTING else max(len(known), 1)
+        pool = price_pool(panel.prices, TRADING_DAYS) if len(known) > step else nullcontext()
+
+        with pool as executor:  # one pool across the checkpointed slices
+            for start in range(0, len(known), step):
+                chunk = known[start:start + step]
+                index_pairs = [(panel.columns[key[1]], panel.columns[key[2]]) for key in chunk]
+                with stage("cointegrate"):
+                    codes, p_values = evaluate_parallel(panel.prices, index_pairs, TRADING_DAYS, executor=executor,
+                                                        screen=SCREEN_THRESHOLD if SCREENING else None)
+                if PROFILE:
+                    count_outcomes(panel, chunk, codes, p_values)
+
+                record_results(chunk, codes, p_values)
+                if CHECKPOINTING:
+                    save_checkpoint()
+
+        for key in unknown:  # after the checkpoints, so a resumed run retries loading them
+            RESULTS[key] = (coint_return.INVALID, None)
+
+    return [RESULTS[key] for key in keys]
+
+
+def record_results(keys, codes, p_values):
+    """
+    Stores the output of evaluate_pairs() in RESULTS
+
+    Globals:
+    RESULTS (dictionary): Store of (coint_return, p_value) tuples
+
+    Parameters:
+    keys (list): RESULTS keys of the evaluated pairs
+    codes (numpy.ndarray): coint_return value per pair
+    p_values (numpy.ndarray): Engle-Granger p-value per pair
+    """
+
+    for key, code, p_value in zip(keys, codes, p_values):
+        result = coint_return(int(code))
+        RESULTS[key] = (result, None if result == coint_return.INVALID else float(p_value))
+
+
+def count_unloaded(panel, keys):
+    """
+    Counts pairs that are INVALID because a ticker could not be loaded,
+    either because it could not be downloaded or because its cached prices
+    could not be read
+
+    Globals:
+    QUARTER (string): The quarter the pairs were tested in
+
+    Parameters:
+    panel (PricePanel): Panel the pairs were loaded into
+    keys (list): RESULTS keys of pairs with a ticker missing from the panel
+    """
+
+    for key in keys:
+        tickers = [ticker for ticker in key[1:] if ticker not in panel.columns]
+        failed = any(not path.isfile("stocks/{}/{}.csv".format(QUARTER, ticker)) for ticker in tickers)
+        count("invalid.download_failure" if failed else "invalid.unreadable_prices")
+
+    count("result.INVALID", len(keys))
+
+
+def count_outcomes(panel, keys, codes, p_values):
+    """
+    Counts each coint_return outcome of a tested batch, splitting INVALID
+    into pairs with too few shared days and pairs that failed numerically
+    (colinear or constant prices), and counting pairs screened out before
+    the full test
+
+    Globals:
+    TRADING_DAYS (int): Amount of trading days for the quarter
+
+    Parameters:
+    panel (PricePanel): Panel the pairs were tested on
+    keys (list): RESULTS keys of the tested pairs
+    codes (numpy.ndarray): coint_return value per pair
+    p_values (numpy.ndarray): Engle-Granger p-value per pair
+    """
+
+    codes = np.asarray(codes)
+    for result in coint_return:
+        count("result.{}".format(result.name), int(np.count_nonzero(codes == result.value)))
+    count("screened", int(np.count_nonzero(
+        (codes == coint_return.NO_RELATIONSHIP.value) & np.isnan(p_values))))
+
+    invalid = codes == coint_return.INVALID.value
+    if invalid.any():
+        enough = panel.overlapping([key[1:] for key in keys], TRADING_DAYS)
+        count("invalid.too_few_days", int(np.count_nonzero(invalid & ~enough)))
+        count("invalid.numeric_failure", int(np.count_nonzero(invalid & enough)))
+
+
+def save_checkpoint():
+    """
+    Writes the current quarter's results in RESULTS to its checkpoint file,
+    so an interrupted run can resume without re-testing them.
+    cointegrate_batch() only stores pairs in RESULTS once they are decided,
+    so pairs it had not reached are tested by the resumed run
+
+    Globals:
+    QUARTER (string): The quarter to checkpoint
+    CHECKPOINT_FILE (string): Checkpoint path, formatted with the quarter
+    """
+
+    checkpoint = CHECKPOINT_FILE.format(QUARTER)
+    results = {key: (result.value, p_value)
+               for key, (result, p_value) in RESULTS.items() if key[0] == QUARTER}
+
+    makedirs(path.dirname(checkpoint), exist_ok=True)
+    push_cache(checkpoint + ".tmp", results)
+    replace(checkpoint + ".tmp", checkpoint)
+
+
+def load_checkpoint():
+    """
+    Restores the current quarter's results from its checkpoint file, if any
+
+    Globals:
+    QUARTER (string): The quarter to restore
+    CHECKPOINT_FILE (string): Checkpoint path, formatted with the quarter
+    """
+
+    checkpoint = CHECKPOINT_FILE.format(QUARTER)
+
+    if path.isfile(checkpoint):
+        for key, (value, p_value) in pop_cache(checkpoint).items():
+            RESULTS[key] = (coint_return(value), p_value)
+#endregion
+
+
+#region Parallel
+def _attach_prices(name, shape, days):
+    """
+    Worker initialiser, attaching to the shared price matrix once per process
+    """
+
+    global WORKER_MEMORY, WORKER_PRICES, WORKER_DAYS
+
+    WORKER_MEMORY = SharedMemory(name=name)
+    WORKER_PRICES = np.ndarray(shape, dtype=float, buffer=WORKER_MEMORY.buf)
+    WORKER_DAYS = days
+
+
+def _attach_store(filename, days):
+    """
+    Worker initialiser, memory-mapping the quarter's binary store so every
+    worker shares the same page cache
+    """
+
+    global WORKER_PRICES, WORKER_DAYS
+
+    WORKER_PRICES = np.load(filename, mmap_mode="r")
+    WORKER_DAYS = days
+
+
+def _map_chunks(executor, prices, pairs, days, screen):
+    """
+    Runs _evaluate_chunk() over CHUNK_SIZE chunks of pairs in a pool started
+    by price_pool(), in input order, falling back to evaluate_pairs() in
+    this process if there is no pool or it breaks
+    """
+
+    if executor is None or len(pairs) == 0:
+        return evaluate_pairs(prices, pairs, days, screen)
+
+    chunks = np.array_split(pairs, -(-len(pairs) // CHUNK_SIZE))
+
+    try:
+        outputs = list(executor.map(_evaluate_chunk, chunks, [screen] * len(chunks)))
+    except (OSError, BrokenProcessPool):
+        return evaluate_pairs(prices, pairs, days, screen)
+
+    return (np.concatenate([results for results, _ in outputs]),
+            np.concatenate([p_values for _, p_values in outputs]))
+
+
+def _evaluate_chunk(pairs, screen):
+    """
+    Worker task, cointegrating a chunk of pairs against the shared prices
+    """
+
+    return evaluate_pairs(WORKER_PRICES, pairs, WORKER_DAYS, screen)
+
+
+@contextmanager
+def price_pool(prices, days, workers=None):
+    """
+    Starts a pool of worker processes attached to a price matrix, so several
+    evaluate_parallel() calls over the same prices share one pool
+
+    Workers memory-map the price matrix directly when it is backed by the
+    quarter's binary store; otherwise it is copied once into shared memory
+    that every worker attaches to
+
+    Globals:
+    WORKERS (int): Default number of worker processes
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    days (int): Minimum number of days both tickers must have traded
+    workers (int, default: None): Number of worker processes, WORKERS if None
+
+    Returns:
+    executor (ProcessPoolExecutor): The pool, None for a single worker or if
+    the pool cannot be started
+    """
+
+    workers = WORKERS if workers is None else workers
+    memory = None
+
+    if workers <= 1:
+        yield None
+        return
+
+    try:
+        if isinstance(prices, np.memmap) and prices.filename is not None:
+            initializer, initargs = _attach_store, (prices.filename, days)
+        else:
+            memory = SharedMemory(create=True, size=max(prices.nbytes, 1))
+            np.ndarray(prices.shape, dtype=float, buffer=memory.buf)[:] = prices
+            initializer, initargs = _attach_prices, (memory.name, prices.shape, days)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    except OSError:
+        executor = None
+
+    try:
+        if executor is None:
+            yield None
+        else:
+            with executor:
+                yield executor
+    finally:
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+
+def evaluate_parallel(prices, pairs, days, workers=None, screen=None, executor=None):
+    """
+    Cointegrates a batch of pairs across a pool of worker processes
+
+    Only the chunks of index pairs are pickled, and chunks are returned in
+    input order so the results are identical to a serial run. Falls back to
+    evaluate_pairs() in this process for a single worker, small batches, or
+    if the pool cannot be started
+
+    Globals:
+    WORKERS (int): Default number of worker processes
+    CHUNK_SIZE (int): Number of pairs sent to a worker at a time
+
+    Parameters:
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+    days (int): Minimum number of days both tickers must have traded
+    workers (int, default: None): Number of worker processes, WORKERS if None
+    screen (float, default: None): Pre-screen threshold, passed to
+    evaluate_pairs()
+    executor (ProcessPoolExecutor, default: None): Pool from price_pool()
+    over the same prices and days to use instead of starting one, for any
+    size of batch
+
+    Returns:
+    results (numpy.ndarray): coint_return value per pair
+    p_values (numpy.ndarray): Engle-Granger p-value per pair, NaN if invalid
+    """
+
+    workers = WORKERS if workers is None else workers
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+
+    if executor is not None:
+        return _map_chunks(executor, prices, pairs, days, screen)
+
+    if workers <= 1 or len(pairs) <= CHUNK_SIZE:
+        return evaluate_pairs(prices, pairs, days, screen)
+
+    with price_pool(prices, days, workers) as executor:
+        return _map_chunks(executor, prices, pairs, days, screen)
+#endregion
+
+
+#region Set generation
+def pairs_with_links(query):
+    """
+    Finds the number of links for each pair of companies from query
+
+    Should only be used for employee_type.DIRECTOR or employee_type.EMPLOYEE
+
+    Parameters:
+    query (list): List of tuples in format (SEC report URL, name, ticker1,
+    ticker2)
+
+    Returns:
+    sorted_pairs (dictionary): Dictionary of pair (key) and number of links
+    (value)
+    """
+
+    pair_people_out = {}
+    remove_keys = set()
+
+    for row in query:
+        sec_report, person, ticker1, ticker2 = row
+        ticker1, ticker2 = clean(str(ticker1).upper()), clean(str(ticker2).upper())
+        pair = (ticker1, ticker2)
+
+        if pair in pair_people_out:
+            pair_people_out[pair].append(person)
+        else:
+            pair_people_out[pair] = [person]
+
+    for key in pair_people_out:
+        key_reversed = (key[1], key[0])
+
+        if key[0] == key[1]:  # reflexive pairs
+            remove_keys.add(key)
+        elif key_reversed in pair_people_out and key not in remove_keys:  # transitive pairs
+            remove_keys.add(key_reversed)
+
+    for key in remove_keys:
+        pair_people_out.pop(key)
+
+    for key in pair_people_out:
+        people = set(pair_people_out[key])  # remove duplicate people
+        pair_people_out[key] = len(people)  # amount of links
+
+    return {k: v for k, v in sorted(
+        pair_people_out.items(), key=lambda item: item[1], reverse=True)}  # sorts dictionary descending by number of links
+
+
+def linked_pairs(ontology, type):
+    """
+    Finds the number of links for each pair of companies directly from the
+    ontology's person -> tickers index
+
+    Gives the same pairs and counts as pairs_with_links(query(graph, type))
+    without the SPARQL self-join or its reflexive and reversed rows: each
+    person's cleaned tickers are combined once, so every pair is emitted in
+    canonical (sorted) order
+
+    Should only be used for employee_type.DIRECTOR or employee_type.EMPLOYEE
+
+    Parameters:
+    ontology (Ontology): Extracted edges for the quarter
+    type (employee_type): Employee type to find links for
+
+    Returns:
+    sorted_pairs (dictionary): Dictionary of pair (key) and number of links
+    (value)
+    """
+
+    pair_people = linked_people(ontology, type)
+
+    return {pair: len(people) for pair, people in sorted(
+        pair_people.items(), key=lambda item: len(item[1]), reverse=True)}  # sorts dictionary descending by number of links
+
+
+def linked_people(ontology, type):
+    """
+    Finds the people linking each pair of companies, the links counted by
+    linked_pairs()
+
+    Parameters:
+    ontology (Ontology): Extracted edges for the quarter
+    type (employee_type): Employee type to find links for
+
+    Returns:
+    pair_people (dictionary): Dictionary of pair (key), in canonical
+    (sorted) order, and set of names (value)
+    """
+
+    pair_people = {}
+    raw = list({ticker for tickers in ontology.employment.values() for ticker in tickers})
+    cleaned_tickers = dict(zip(raw, clean_series(ticker.upper() for ticker in raw)))
+
+    for person, tickers in ontology.employment.items():
+        if type == employee_type.DIRECTOR and (person not in ontology.directors or not ontology.has_period):
+            continue
+
+        names = ontology.names.get(person)
+        if not names:
+            continue
+
+        cleaned = sorted({cleaned_tickers[ticker] for ticker in tickers})  # dropping reflexive pairs
+        for pair in combinations(cleaned, 2):
+            pair_people.setdefault(pair, set()).update(names)
+
+    return pair_people
+
+
+def triangle_pair(index, n):
+    """
+    Maps an index into the n * (n - 1) / 2 combinations of n items to its
+    pair, in the same order as itertools.combinations(range(n), 2)
+
+    Parameters:
+    index (int): Combination index
+    n (int): Number of items
+
+    Returns:
+    pair (tuple): Item indices (i, j) with i < j
+    """
+
+    i = n - 2 - (isqrt(4 * n * (n - 1) - 8 * index - 7) - 1) // 2
+    j = index + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2
+
+    return (i, j)
+
+
+def sample_pairs(n, seed=RANDOM_SEED):
+    """
+    Draws distinct pairs of n items uniformly without replacement, without
+    materialising every combination
+
+    Pairs are drawn by index into the implicit triangle of combinations and
+    only the indices already drawn are kept, so memory is proportional to
+    the number of pairs drawn
+
+    Parameters:
+    n (int): Number of items
+    seed (int, default: RANDOM_SEED): Seed for reproducible draws
+
+    Returns:
+    pairs (generator): Item indices (i, j) with i < j
+    """
+
+    rng = Random(seed)
+    total = n * (n - 1) // 2
+    seen = set()
+
+    while len(seen) < total:
+        index = rng.randrange(total)
+        if index in seen:
+            continue
+        seen.add(index)
+        yield triangle_pair(index, n)
+
+
+def generate_random_set(companies, size, exclusion_list=None, seed=RANDOM_SEED):
+    """
+    Generates a set of validated pairs by randomly selecting pairs from every
+    combination of every company in the ontology for a given quarter
+
+    Removes transitive, duplicate, erroneous, and reversed pairs. Tickers
+    without TRADING_DAYS of prices are dropped before any pair is formed, and
+    candidates without enough shared days are dropped before testing.
+    Candidates are drawn without replacement by sample_pairs() and validated
+    a batch at a time by stream_random_set()
+
+    Parameters:
+    companies (list): List of all companies in ontology
+    size (int): Number of pairs to generate
+    exclusion_list (set, default: None): Pairs to ignore in either order.
+    Typically used to remove pairs of linked companies.
+    seed (int, default: RANDOM_SEED): Seed for reproducible sets
+
+    Returns:
+    pair_set (list): List of validated pairs, in the order drawn
+    """
+
+    return [pair for pair, _ in stream_random_set(companies, size, exclusion_list, seed)]
+
+
+def stream_random_set(companies, size, exclusion_list=None, seed=RANDOM_SEED, batch=None):
+    """
+    Draws and validates the pairs of generate_random_set(), yielding each
+    validated pair with its result as soon as its draw batch is tested
+
+    Batches never draw more than the pairs still needed, so the set is the
+    same for any batch size
+
+    Globals:
+    TRADING_DAYS (int): Amount of trading days for the quarter
+
+    Parameters:
+    companies (list): List of all companies in ontology
+    size (int): Number of pairs to generate
+    exclusion_list (set, default: None): Pairs to ignore in either order
+    seed (int, default: RANDOM_SEED): Seed for reproducible sets
+    batch (int, default: None): Most candidates drawn at a time, as many as
+    are still needed if None
+
+    Returns:
+    pairs (generator): Tuples of pair and (coint_return, p_value), in the
+    order drawn
+    """
+
+    panel = get_panel()
+    panel.load(companies)
+    companies = panel.tradeable(sorted(set(companies)), TRADING_DAYS)  # sorted for reproducibility
+    exclusion_list = exclusion_list or set()
+    sampler = sample_pairs(len(companies), seed)
+    validated = 0
+
+    while validated < size:
+        drawn = list(islice(sampler, size - validated if batch is None else min(size - validated, batch)))
+        if not drawn:  # every combination has been tried
+            break
+
+        candidates = [(companies[i], companies[j]) for i, j in drawn]
+        candidates = [pair for pair in candidates
+                      if pair not in exclusion_list and (pair[1], pair[0]) not in exclusion_list]
+        candidates = [pair for pair, valid in zip(
+            candidates, panel.overlapping(candidates, TRADING_DAYS)) if valid]
+
+        for pair, result in zip(candidates, cointegrate_batch(candidates)):
+            if result[0] != coint_return.INVALID:
+                validated += 1
+                yield pair, result
+
+
+def generate_linked_set(companies):
+    """
+    Generates a set of validated pairs given a list of pairs sharing links
+
+    Should only be used for a list of linked pairs AFTER being verified by
+    pairs_with_links
+
+    Removes transitive, duplicate, erroneous, and reversed pairs.
+
+    Parameters:
+    companies (list): List of linked pairs in ontology
+
+    Returns:
+    pair_set (list): List of validated pairs
+    """
+
+    pair_set = {}  # dictionary rather than set to keep the input order
+    companies = list(companies)
+    results = cointegrate_batch(companies)
+
+    for pair, (result, p_value) in zip(companies, results):
+        reversed_pair = (pair[1], pair[0])
+
+        if pair[0] == pair[1] or pair in pair_set or result == coint_return.INVALID or reversed_pair in pair_set:
+            pass
+        else:
+            pair_set[pair] = None
+    # pair_counts = dict(pd.Series(pair_counts).value_counts()) # number of links
+
+    return list(pair_set)
+
+
+def stratify_linked_set(employee_dict):
+    """
+    Validates every linked pair once, keeping each pair's exact number of
+    links, so the set for any minimum number of links is a mask over one
+    list rather than a new set
+
+    Parameters:
+    employee_dict (dictionary): Dictionary of pair (key) and number of links
+    (value), as returned by linked_pairs()
+
+    Returns:
+    pairs (list): List of validated pairs, in the order of
+    generate_linked_set()
+    links (numpy.ndarray): Number of links of each pair
+    """
+
+    pairs = generate_linked_set(employee_dict)
+    links = np.array([employee_dict[pair] for pair in pairs], dtype=np.int64)
+
+    return pairs, links
+
+
+def link_strata(links, codes, intervals):
+    """
+    Counts the pairs with at least k links, and how many of them are
+    cointegrated, for each k in intervals
+
+    Pairs are bucketed once by their exact number of links; the counts for
+    at least k links are reverse cumulative sums over the buckets, so any
+    number of intervals costs the same
+
+    Parameters:
+    links (numpy.ndarray): Number of links of each pair
+    codes (numpy.ndarray): coint_return value of each pair
+    intervals (list): Minimum numbers of links
+
+    Returns:
+    strata (dictionary): Minimum number of links (key) and tuple of pairs
+    and cointegrated pairs (value)
+    """
+
+    links = np.asarray(links, dtype=np.int64)
+    pairs = np.bincount(links, minlength=1)
+    cointegrated = np.bincount(links[np.asarray(codes) == coint_return.RELATIONSHIP.value], minlength=len(pairs))
+    at_least = np.cumsum(pairs[::-1])[::-1]
+    at_least_cointegrated = np.cumsum(cointegrated[::-1])[::-1]
+
+    return {interval: (int(at_least[max(interval, 0)]), int(at_least_cointegrated[max(interval, 0)]))
+            if interval < len(pairs) else (0, 0) for interval in intervals}
+#endregion
+
+
+#region Results
+class SlidingResults:
+    def __init__(self, ticker1, ticker2):
+        self.ticker1 = np.asarray(ticker1, dtype=object)
+        self.ticker2 = np.asarray(ticker2, dtype=object)
+        self.quarters = {}
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Creates an accumulator with one row, identified by its position, per
+        pair
+
+        Parameters:
+        pairs (list): List of (ticker1, ticker2) pairs
+
+        Returns:
+        results (SlidingResults): Accumulator with no quarters
+        """
+
+        pairs = list(pairs)
+
+        return cls([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+
+    @classmethod
+    def read(cls, directory):
+        """
+        Reads a results CSV, accepting both the ticker1/ticker2 columns and
+        the older stringified "pair" column
+
+        Parameters:
+        directory (string): Path to results CSV
+
+        Returns:
+        results (SlidingResults): Accumulator with the quarters in the file
+        """
+
+        with stage("results_read"):
+            frame = pd.read_csv(directory, dtype=str, keep_default_na=False)
+
+        if "pair" in frame:
+            tickers = frame.pop("pair").str.extract(LEGACY_PAIR)
+            frame.insert(0, "ticker1", tickers[0])
+            frame.insert(1, "ticker2", tickers[1])
+
+        results = cls(frame.pop("ticker1").to_numpy(), frame.pop("ticker2").to_numpy())
+        codes = {label: code for code, label in enumerate(RESULT_LABELS[:-1])}
+        for quarter in frame:
+            results.quarters[quarter] = frame[quarter].map(codes).fillna(-1).to_numpy(dtype=np.int8)
+
+        return results
+
+    def pairs(self):
+        """
+        Returns:
+        pairs (list): List of (ticker1, ticker2) pairs in row order
+        """
+
+        return list(zip(self.ticker1, self.ticker2))
+
+    def extend(self, pairs):
+        """
+        Appends pairs, leaving them untested in the existing quarters
+
+        Parameters:
+        pairs (list): List of (ticker1, ticker2) pairs
+        """
+
+        pairs = list(pairs)
+        self.ticker1 = np.concatenate((self.ticker1, np.asarray([pair[0] for pair in pairs], dtype=object)))
+        self.ticker2 = np.concatenate((self.ticker2, np.asarray([pair[1] for pair in pairs], dtype=object)))
+        for quarter, codes in self.quarters.items():
+            self.quarters[quarter] = np.concatenate((codes, np.full(len(pairs), -1, dtype=np.int8)))
+
+    def set_quarter(self, quarter, results):
+        """
+        Records a quarter's results for every row in one operation
+
+        Parameters:
+        quarter (string): Quarter column to write
+        results (list): (coint_return, p_value) tuples in row order, as
+        returned by cointegrate_batch()
+        """
+
+        self.quarters[quarter] = np.fromiter(
+            (result.value for result, _ in results), dtype=np.int8, count=len(self.ticker1))
+
+    def write(self, directory):
+        """
+        Writes the results as a CSV of ticker1, ticker2 and one column per
+        quarter holding True, False or DISSOLVED
+
+        Parameters:
+        directory (string): Path to results CSV
+        """
+
+        frame = pd.DataFrame({"ticker1": self.ticker1, "ticker2": self.ticker2})
+        for quarter, codes in self.quarters.items():
+            frame[quarter] = RESULT_LABELS[codes]
+
+        with stage("results_write"):
+            frame.to_csv(directory, index=False)
+#endregion
+
+
+#region Experiments
+def set_quarter(obj):
+    """
+    Selects the quarter that the stock, ontology and cointegration functions
+    operate on
+
+    Globals:
+    COINTEGRATION_START_DATE (datetime): Set to the start of the quarter
+    COINTEGRATION_END_DATE (datetime): Set to the end of the quarter
+    TRADING_DAYS (int): Set to the amount of trading days for the quarter
+    QUARTER (string): Set to the quarter's folder
+    CALENDAR (pandas.DatetimeIndex): Set to the quarter's trading days
+
+    Parameters:
+    obj (Quarter): Quarter to select
+    """
+
+    global COINTEGRATION_START_DATE
+    global COINTEGRATION_END_DATE
+    global TRADING_DAYS
+    global QUARTER
+    global CALENDAR
+
+    COINTEGRATION_START_DATE = obj.start
+    COINTEGRATION_END_DATE = obj.end
+    TRADING_DAYS = obj.days
+    QUARTER = obj.folder
+    CALENDAR = obj.dates
+
+
+def migrate_csv_cache(quarters=None):
+    """
+    Converts each quarter's cache of per-ticker CSV files into the binary
+    price store read by PricePanel
+
+    Parameters:
+    quarters (list, default: None): Quarters to convert, e.g. "2017Q2",
+    every stocks/<quarter>/ folder if None
+    """
+
+    if quarters is None:
+        quarters = sorted(path.basename(path.dirname(folder)) for folder in glob("stocks/*/")
+                          if QUARTER_NAME.fullmatch(path.basename(path.dirname(folder))))
+
+    for quarter in quarters:
+        tickers = [path.splitext(path.basename(csv))[0]
+                   for csv in sorted(glob("stocks/{}/*.csv".format(quarter)))]
+        set_quarter(get_quarter(quarter, tickers))
+        get_panel().load(tickers)
+
+
+def cointegrated_count(pairs, type, interval): # todo: change the function of this to just generate csv files or depreciate
+    """
+    Counts how many pairs are cointegrated given a list of pairs
+
+    Globals:
+    QUARTER (string): The quarter from which the pairs were selected
+
+    Parameters:
+    pairs (list): List of pairs
+    type (employee_type): Whether the pair set is linked or random, used to
+    set save directory
+    interval (int): Minimum number of links, used to set save directory
+
+    Returns:
+    count (int): Number of cointegrated pairs
+    """
+
+    if type == employee_type.ALL: # todo: update to new directory structure
+        directory = "experiments/random.csv"
+    elif type == employee_type.EMPLOYEE:
+        directory = "experiments/employees_interval_{}.csv".format(interval)
+
+    if path.isfile(directory):
+        cointegrated = SlidingResults.read(directory)
+    else:
+        cointegrated = SlidingResults.from_pairs([])
+
+    existing_pairs = set(cointegrated.pairs())
+    if pairs is None:
+        pairs = cointegrated.pairs()
+    cointegrated.extend(pair for pair in dict.fromkeys(pairs) if pair not in existing_pairs)
+
+    results = cointegrate_batch(cointegrated.pairs())
+    cointegrated.set_quarter(QUARTER, results)
+    cointegrated.write(directory)
+
+    requested = set(pairs)
+    count = sum(1 for pair, (result, p_value) in zip(cointegrated.pairs(), results)
+                if result == coint_return.RELATIONSHIP and pair in requested)
+
+    return count
+
+
+def results_directory(type, quarter, interval=None):
+    """
+    Path of the sliding window results for a pair set starting in a quarter
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random
+    quarter (string): Quarter the pair set was selected from
+    interval (int, default: None): Minimum number of links for linked sets
+
+    Returns:
+    directory (string): Path to results CSV
+    """
+
+    if type == employee_type.ALL:
+        return "experiments/random_no_links/random_{}.csv".format(quarter)
+    elif type == employee_type.EMPLOYEE:
+        return "experiments/employees/interval_{}/employee_{}_{}.csv".format(
+            interval, interval, quarter)
+
+
+def has_results(type, quarter, column, interval=None):
+    """
+    Checks whether a quarter's column has already been written to the
+    results for a pair set
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random
+    quarter (string): Quarter the pair set was selected from
+    column (string): Quarter column to look for
+    interval (int, default: None): Minimum number of links for linked sets
+
+    Returns:
+    exists (bool): Whether the column exists
+    """
+
+    directory = results_directory(type, quarter, interval)
+
+    return path.isfile(directory) and column in pd.read_csv(directory, nrows=0).columns
+
+
+def sliding_new(type, pairs, interval=None):
+    """
+    Generates initial sliding window (first set of results)
+
+    Differs from sliding_existing by creating a new dataframe
+
+    Globals:
+    QUARTER (string): The quarter from which the pairs were selected, used to
+    set save directory
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random, used to
+    set save directory
+    pairs (list): List of pairs
+    interval (int, default: None): Minimum number of links, used to set save
+    directory
+    """
+
+    directory = results_directory(type, QUARTER, interval)
+    cointegrated = SlidingResults.from_pairs(pairs)
+    cointegrated.set_quarter(QUARTER, cointegrate_batch(cointegrated.pairs()))
+    cointegrated.write(directory)
+
+
+def sliding_existing(type, previous_quarter, interval=None): # todo, collapse sliding_new and sliding_existing
+    """
+    Generates sliding window results after the first set has been created
+
+    Differs from sliding_new by operating on an existing dataframe
+
+    Globals:
+    QUARTER (string): The quarter from which the pairs were selected, used to
+    select existing CSV
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random, used to
+    set save directory
+    previous_quarter (string): Derived from previous Quarter object, used to
+    select existing CSV
+    interval (int, default: None): Minimum number of links, used to set save
+    directory
+    """
+
+    directory = results_directory(type, previous_quarter, interval)
+    cointegrated = SlidingResults.read(directory)
+    cointegrated.set_quarter(QUARTER, cointegrate_batch(cointegrated.pairs()))
+    cointegrated.write(directory)
+
+
+def generate_linked_results(intervals=None):
+    """
+    Generates results for linked companies, outputting the number of
+    cointegrated pairs at each interval
+
+    Each linked pair is tested once and the counts for every interval are
+    taken from link_strata()
+
+    Globals:
+    OBJECT_LIST (list): List of quarters of type Quarter
+    COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
+    information for, passed to cointegrate()
+    COINTEGRATION_END_DATE (datetime): End of period to retrieve stock
+    information for, passed to cointegrate()
+    TRADING_DAYS (int): Amount of trading days for the quarter, passed to
+    cointegrate()
+    QUARTER (string): The quarter to select pairs from, passed to multiple
+    methods
+    LINK_INTERVALS (list): Default minimum numbers of links
+
+    Parameters:
+    intervals (list, default: None): Minimum numbers of links to output,
+    LINK_INTERVALS if None
+    """
+
+    intervals = LINK_INTERVALS if intervals is None else intervals
+
+    for obj in OBJECT_LIST:
+        set_quarter(obj)
+
+        ontology = load_ontology()
+        employee_dict = linked_pairs(ontology, employee_type.EMPLOYEE)
+
+        cointegrated_count(None, employee_type.ALL, None)
+
+        employee_pairs, links = stratify_linked_set(employee_dict)
+        cointegrated_count([pair for pair, selected in zip(employee_pairs, links >= min(intervals)) if selected],
+                           employee_type.ALL, None)
+        codes = np.fromiter((result.value for result, _ in cointegrate_batch(employee_pairs)),
+                            dtype=np.int8, count=len(employee_pairs))
+        strata = link_strata(links, codes, intervals)
+
+        with open("experiments/output/{}.txt".format(QUARTER), "a") as results:
+            for interval in intervals:
+                pairs, cointegrated = strata[interval]
+
+                results.write("\nEmployee set cointegrated ({} links(s)): {}\n".format(
+                    interval, cointegrated))
+                results.write("Total pairs in employee set: {}\n".format(pairs))
+
+        profile_summary(QUARTER)
+
+
+def generate_survival(type, incremental=False, intervals=None):
+    """
+    Generates sliding window results for both random and linked pairs
+
+    In incremental mode, only the (pair set, quarter) cells missing from the
+    results files are computed, quarters with nothing missing are skipped
+    without loading their ontology or prices, and each quarter's results are
+    checkpointed so an interrupted run resumes where it stopped
+
+    Globals:
+    OBJECT_LIST (list): List of quarters of type Quarter
+    COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
+    information for, passed to cointegrate()
+    COINTEGRATION_END_DATE (datetime): End of period to retrieve stock
+    information for, passed to cointegrate()
+    TRADING_DAYS (int): Amount of trading days for the quarter, passed to
+    cointegrate()
+    QUARTER (string): The quarter to select pairs from, passed to multiple
+    methods
+    CHECKPOINTING (bool): Set for the duration of an incremental run
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random, used to
+    set save directory
+    incremental (bool, default: False): Whether to only compute missing
+    results
+    intervals (list, default: None): Minimum numbers of links of the linked
+    sets, LINK_INTERVALS if None
+    """
+
+    global CHECKPOINTING
+
+    previous_quarter = None
+    if type == employee_type.ALL:
+        intervals = [None]
+    elif intervals is None:
+        intervals = LINK_INTERVALS
+    CHECKPOINTING = incremental
+
+    try:
+        for obj in OBJECT_LIST:
+            set_quarter(obj)
+
+            new = [interval for interval in intervals
+                   if not (incremental and has_results(type, QUARTER, QUARTER, interval))]
+            existing = [interval for interval in intervals if previous_quarter is not None
+                        and not (incremental and has_results(type, previous_quarter, QUARTER, interval))]
+
+            if new or existing:
+                if incremental:
+                    load_checkpoint()
+                if new:
+                    sliding_sets(type, new)
+                for interval in existing:
+                    sliding_existing(type, previous_quarter, interval=interval)
+                if incremental and path.isfile(CHECKPOINT_FILE.format(QUARTER)):
+                    remove(CHECKPOINT_FILE.format(QUARTER))
+
+            previous_quarter = QUARTER
+            profile_summary(QUARTER)
+    finally:
+        CHECKPOINTING = False
+
+
+def sliding_sets(type, intervals):
+    """
+    Generates the quarter's pair sets and their initial sliding windows
+
+    The linked pairs are validated and tested once, each interval's set
+    being the pairs with at least that many links
+
+    Globals:
+    QUARTER (string): The quarter to select pairs from
+    RANDOM_SET_SIZE (int): Number of pairs in the random set
+
+    Parameters:
+    type (employee_type): Whether the pair set is linked or random
+    intervals (list): Minimum numbers of links to generate linked sets for,
+    [None] for the random set
+    """
+
+    ontology = load_ontology()
+    employee_dict = linked_pairs(ontology, employee_type.EMPLOYEE)
+
+    if type == employee_type.ALL:
+        companies_list = set(clean_series(
+            str(row[0]).upper() for row in ontology.query(employee_type.ALL)))
+        employee_pairs = [x for x in list(
+            employee_dict) if employee_dict[x] >= 1]
+        random_pairs = generate_random_set(
+            list(companies_list), RANDOM_SET_SIZE, exclusion_list=set(employee_pairs))
+
+        sliding_new(type, random_pairs)
+
+    elif type == employee_type.EMPLOYEE:
+        pairs, links = stratify_linked_set(employee_dict)
+
+        for interval in intervals:
+            employee_pairs = [pair for pair, selected in zip(pairs, links >= interval) if selected]
+
+            sliding_new(type, employee_pairs, interval=interval)
+
+
+def screen_report(threshold=None, files=None):
+    """
+    Validates the pre-screen against the results already written to
+    experiments/: for each results file and quarter column, how many pairs
+    the screen would pass and whether it would have dropped any pair
+    recorded as cointegrated
+
+    Globals:
+    SCREEN_THRESHOLD (float): Default threshold
+
+    Parameters:
+    threshold (float, default: None): Threshold to validate,
+    SCREEN_THRESHOLD if None
+    files (list, default: None): Results CSVs, every CSV under experiments/
+    if None
+
+    Returns:
+    records (generator): Dictionaries with file, quarter, pairs (tested
+    pairs with prices), passed, pass_rate, accepted (recorded as
+    cointegrated), missed (accepted but screened out), agreement (share of
+    accepted that passed) and safe_threshold (largest statistic of an
+    accepted pair, the tightest threshold that misses none)
+    """
+
+    threshold = SCREEN_THRESHOLD if threshold is None else threshold
+    files = sorted(glob("experiments/**/*.csv", recursive=True)) if files is None else files
+    results = {directory: SlidingResults.read(directory) for directory in files}
+    columns = sorted({quarter for cointegrated in results.values()
+                      for quarter in cointegrated.quarters if QUARTER_NAME.fullmatch(quarter)})
+
+    for column in columns:
+        set_quarter(get_quarter(column))
+        panel = get_panel()
+
+        for directory, cointegrated in results.items():
+            if column not in cointegrated.quarters:
+                continue
+
+            recorded = cointegrated.quarters[column]
+            panel.load(ticker for pair, code in zip(cointegrated.pairs(), recorded)
+                       if code != -1 for ticker in pair)
+            rows = [row for row, (pair, code) in enumerate(zip(cointegrated.pairs(), recorded))
+                    if code != -1 and pair[0] in panel.columns and pair[1] in panel.columns]
+            pairs = [(cointegrated.ticker1[row], cointegrated.ticker2[row]) for row in rows]
+            rows = [row for row, valid in zip(rows, panel.overlapping(pairs, TRADING_DAYS)) if valid]
+
+            stats = screen_statistic(panel.prices, [(panel.columns[cointegrated.ticker1[row]],
+                                                     panel.columns[cointegrated.ticker2[row]])
+                                                    for row in rows])
+            with np.errstate(invalid="ignore"):
+                passed = ~(stats > threshold)
+            accepted = recorded[rows] == coint_return.RELATIONSHIP.value
+
+            yield {"file": directory, "quarter": column, "pairs": len(rows),
+                   "passed": int(passed.sum()),
+                   "pass_rate": float(passed.mean()) if rows else None,
+                   "accepted": int(accepted.sum()),
+                   "missed": int((accepted & ~passed).sum()),
+                   "agreement": float(passed[accepted].mean()) if accepted.any() else None,
+                   "safe_threshold": float(np.nanmax(stats[accepted]))
+                   if accepted.any() and not np.isnan(stats[accepted]).all() else None}
+#endregion
+
+
+#region Survival analytics
+def read_codes(directory):
+    """
+    Reads only the quarter columns of a results CSV as int8 coint_return
+    values, without parsing the tickers, in either the ticker1/ticker2 or
+    the older "pair" layout
+
+    Parameters:
+    directory (string): Path to results CSV
+
+    Returns:
+    codes (dictionary): Quarter to int8 array, -1 where untested
+    """
+
+    frame = pd.read_csv(directory, usecols=lambda column: QUARTER_NAME.fullmatch(column) is not None,
+                        dtype="category", keep_default_na=False)
+    labels = {label: code for code, label in enumerate(RESULT_LABELS[:-1])}
+    codes = {}
+
+    for quarter in frame:
+        categories = frame[quarter].cat
+        lookup = np.array([labels.get(label, -1) for label in categories.categories] + [-1], dtype=np.int8)
+        codes[quarter] = lookup[categories.codes.to_numpy()]  # missing values have category code -1
+
+    return codes
+
+
+def result_files():
+    """
+    Finds the sliding window results of every linked and random pair set
+
+    Returns:
+    files (list): Tuples of (set, interval, cohort quarter, path), where
+    set is "employees" or "random" and interval is None for random sets
+    """
+
+    files = []
+
+    for directory in sorted(glob("experiments/employees/interval_*/*.csv")
+                            + glob("experiments/random_no_links/*.csv")):
+        match = RESULT_FILE.fullmatch(path.basename(directory))
+        if match is None:
+            continue
+        interval, cohort = match.groups()
+        files.append(("random" if interval is None else "employees",
+                      None if interval is None else int(interval), cohort, directory))
+
+    return files
+
+
+def survival_curve(codes, cohort):
+    """
+    Survival of cointegration for a cohort of pairs selected in one quarter,
+    for each following quarter: how many pairs cointegrated in the cohort
+    quarter are still cointegrated in every quarter since, the hazard of
+    losing cointegration, and the transitions between result codes
 
+    Parameters:
+    codes (dictionary): Quarter to int8 coint_return array, as returned by
+    read_codes()
+    cohort (string): Quarter the pairs were selected in
 
-def generate_linked_set(companies):
+    Returns:
+    rows (list): Dictionaries with quarter, lag (quarters since the cohort),
+    pairs, cointegrated (in the cohort quarter), at_risk (cointegrated
+    through the previous quarter), surviving, survival, hazard and a count
+    for each "from->to" pair of result labels
     """
-    Generates a set of validated pairs given a list of pairs sharing links
 
-    Should only be used for a list of linked pairs AFTER being verified by
-    pairs_with_links
+    quarters = sorted(quarter for quarter in codes if quarter >= cohort)
+    if len(quarters) < 2 or quarters[0] != cohort:
+        return []
 
-    Removes transitive, duplicate, erroneous, and reversed pairs.
+    matrix = np.stack([codes[quarter] for quarter in quarters], axis=1)
+    surviving = np.logical_and.accumulate(matrix == coint_return.RELATIONSHIP.value, axis=1).sum(axis=0)
+
+    previous, current = matrix[:, :-1], matrix[:, 1:]
+    tested = (previous >= 0) & (current >= 0)
+    lags = np.broadcast_to(np.arange(current.shape[1]), current.shape)
+    outcomes = len(coint_return)
+    transitions = np.bincount((lags * outcomes * outcomes + previous * outcomes + current)[tested],
+                              minlength=current.shape[1] * outcomes * outcomes).reshape(-1, outcomes * outcomes)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        survival = surviving / surviving[0]
+        hazard = 1 - surviving[1:] / surviving[:-1]
+
+    names = ["{}->{}".format(RESULT_LABELS[first], RESULT_LABELS[second])
+             for first in range(outcomes) for second in range(outcomes)]
+    rows = []
+
+    for lag in range(1, len(quarters)):
+        row = {"quarter": quarters[lag], "lag": lag, "pairs": len(matrix),
+               "cointegrated": int(surviving[0]), "at_risk": int(surviving[lag - 1]),
+               "surviving": int(surviving[lag]), "survival": float(survival[lag]),
+               "hazard": float(hazard[lag - 1])}
+        row.update(zip(names, transitions[lag - 1].tolist()))
+        rows.append(row)
+
+    return rows
+
+
+def survival_summary(files=None):
+    """
+    Survival curves, hazard rates and transitions for every linked and
+    random pair set in one table
 
     Parameters:
-    companies (list): List of linked pairs in ontology
+    files (list, default: None): Tuples as returned by result_files(), every
+    results file if None
 
     Returns:
-    pair_set (list): List of validated pairs
+    summary (pandas.DataFrame): One row per pair set and following quarter,
+    with the set, interval and cohort followed by the columns of
+    survival_curve()
     """
 
-    pair_set = set()
+    rows = []
 
-    for pair in companies:
-        reversed_pair = (pair[1], pair[0])
-        result, p_value = cointegrate(pair[0], pair[1])
+    for name, interval, cohort, directory in result_files() if files is None else files:
+        with stage("results_read"):
+            codes = read_codes(directory)
+        for row in survival_curve(codes, cohort):
+            rows.append(dict({"set": name, "interval": interval, "cohort": cohort}, **row))
 
-        if pair[0] == pair[1] or pair in pair_set or result == coint_return.INVALID or reversed_pair in pair_set:
-            pass
-        else:
-            pair_set.add(pair)
-    # pair_counts = dict(pd.Series(pair_counts).value_counts()) # number of links
+    summary = pd.DataFrame(rows)
+    if not summary.empty:
+        summary["interval"] = summary["interval"].astype("Int64")
 
-    return pair_set
+    return summary
 #endregion
 
 
-#region Experiments
-def cointegrated_count(pairs, type, interval): # todo: change the function of this to just generate csv files or depreciate
+#region Rolling windows
+def _window_sums(values, starts, days):
     """
-    Counts how many pairs are cointegrated given a list of pairs
+    Sums of each window of values from running sums, so sliding a window by
+    one day costs one subtraction however long the window is
+    """
+
+    running = np.concatenate((np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)))
+
+    return running[starts + days] - running[starts]
+
+
+def rolling_engle_granger(prices, pairs, days, step=1):
+    """
+    Engle-Granger p-values over every window of days consecutive dates,
+    stepped by step dates, for each pair
+
+    The regression of each window is updated from running sums of x, y, x^2,
+    y^2 and xy instead of being refitted, and the ADF tests of all windows
+    are batched as in engle_granger(). Windows where either ticker has a
+    missing price are not tested
 
     Globals:
-    QUARTER (string): The quarter from which the pairs were selected
+    CHUNK_SIZE (int): Number of windows tested at a time
 
     Parameters:
-    pairs (list): List of pairs
-    type (employee_type): Whether the pair set is linked or random, used to
-    set save directory
-    interval (int): Minimum number of links, used to set save directory
+    prices (numpy.ndarray): Price matrix of dates x tickers
+    pairs (numpy.ndarray): Array of (i, j) column index pairs
+    days (int): Number of dates in each window
+    step (int, default: 1): Number of dates between window starts
 
     Returns:
-    count (int): Number of cointegrated pairs
+    starts (numpy.ndarray): First date index of each window
+    p_values (numpy.ndarray): MacKinnon p-value of shape (pairs, windows),
+    NaN where the window could not be tested
     """
 
-    count = 0
-    generated_pairs = None
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    starts = np.arange(0, max(prices.shape[0] - days + 1, 0), step)
+    p_values = np.full((len(pairs), len(starts)), np.nan)
 
-    if type == employee_type.ALL: # todo: update to new directory structure
-        directory = "experiments/random.csv"
-    elif type == employee_type.EMPLOYEE:
-        directory = "experiments/employees_interval_{}.csv".format(interval)
+    if len(starts) == 0:
+        return starts, p_values
 
-    if path.isfile(directory):
-        cointegrated = pd.read_csv(directory).set_index("pair")
-        new_cointegrated = pd.DataFrame(columns=["pair", QUARTER])
-        if pairs is None:
-            pairs = [literal_eval(p) for p in cointegrated.index.values]
-        else:
-            existing_pairs = [literal_eval(p)
-                              for p in cointegrated.index.values]
-            generated_pairs = set(pairs)
-            generated_pairs.update(existing_pairs)
-    else:
-        cointegrated = pd.DataFrame(columns=["pair", QUARTER]) # this will not work in its current form, more testing required
-
-    for pair in generated_pairs:
-        result, p_value = cointegrate(pair[0], pair[1])
-        formatted_pair = str(pair)
-        if result == coint_return.RELATIONSHIP:
-            relationship = True
-
-            if pair in pairs:
-                count += 1
-        elif result == coint_return.NO_RELATIONSHIP:
-            relationship = False
-        else:
-            relationship = "DISSOLVED"
+    batch = max(1, CHUNK_SIZE // len(starts))
+    for first in range(0, len(pairs), batch):
+        chunk = pairs[first:first + batch]
+        p_values[first:first + batch] = _rolling_chunk(prices, chunk, days, starts).T
 
-        if formatted_pair in cointegrated.index.values:
-            cointegrated.loc[formatted_pair, QUARTER] = relationship
-        else:
-            new_cointegrated = new_cointegrated.append(
-                {"pair": formatted_pair, QUARTER: relationship}, ignore_index=True)
+    return starts, p_values
 
-    new_cointegrated.set_index("pair", inplace=True)
-    cointegrated = cointegrated.append(new_cointegrated)
-    cointegrated.to_csv(directory)
 
-    return count
+def _rolling_chunk(prices, pairs, days, starts):
+    y = prices[:, pairs[:, 0]]
+    x = prices[:, pairs[:, 1]]
+    complete = ~(np.isnan(x) | np.isnan(y))
 
+    # centred on each ticker's mean so the running sums stay well conditioned
+    observed = np.maximum(complete.sum(axis=0), 1)
+    x = np.where(complete, x - np.where(complete, x, 0).sum(axis=0) / observed, 0.0)
+    y = np.where(complete, y - np.where(complete, y, 0).sum(axis=0) / observed, 0.0)
 
-def sliding_new(type, pairs, interval=None):
+    valid = _window_sums(complete.astype(float), starts, days) == days
+    sx, sy = _window_sums(x, starts, days), _window_sums(y, starts, days)
+    sxx = _window_sums(x * x, starts, days) - sx * sx / days
+    syy = _window_sums(y * y, starts, days) - sy * sy / days
+    sxy = _window_sums(x * y, starts, days) - sx * sy / days
+
+    # a window is constant if no price changes between its first and last day
+    changes = lambda series: np.concatenate((np.zeros((1, series.shape[1])),
+                                             np.cumsum(np.diff(series, axis=0) != 0, axis=0)))
+    constant = ((changes(x)[starts + days - 1] == changes(x)[starts])
+                | (changes(y)[starts + days - 1] == changes(y)[starts]))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = np.where(constant, 0.0, sxy / sxx)
+        rsquared = beta * sxy / syy
+
+    stats = np.full(valid.shape, np.nan)
+    xw = sliding_window_view(x, days, axis=0)[starts]
+    yw = sliding_window_view(y, days, axis=0)[starts]
+    resid = ((yw - (sy / days)[..., None]) - beta[..., None] * (xw - (sx / days)[..., None]))[valid]
+
+    tested = _adf_statistic(resid)
+    tested[rsquared[valid] >= 1 - 100 * SQRTEPS] = -np.inf  # (almost) perfectly colinear
+    tested[constant[valid]] = np.nan  # constant price series
+    stats[valid] = tested
+
+    return mackinnon_p(stats)
+
+
+def rolling_pairs(quarters, interval=1):
     """
-    Generates initial sliding window (first set of results)
+    Every pair linked by at least interval people in any of the quarters,
+    in the order first seen
 
-    Differs from sliding_existing by creating a new dataframe
+    Parameters:
+    quarters (list): List of quarters of type Quarter
+    interval (int, default: 1): Minimum number of links
+
+    Returns:
+    pairs (list): List of (ticker1, ticker2) pairs
+    """
+
+    pairs = {}
+
+    for obj in quarters:
+        set_quarter(obj)
+        employee_dict = linked_pairs(load_ontology(), employee_type.EMPLOYEE)
+        pairs.update((pair, None) for pair, links in employee_dict.items() if links >= interval)
+
+    return list(pairs)
+
+
+def generate_rolling(obj, pairs):
+    """
+    Writes the p-value time series of each pair over a rolling window spec,
+    one row per pair and one column per window labelled by its last date
 
     Globals:
-    QUARTER (string): The quarter from which the pairs were selected, used to
-    set save directory
+    ROLLING_FILE (string): Output path, formatted with the spec's folder
 
     Parameters:
-    type (employee_type): Whether the pair set is linked or random, used to
-    set save directory
-    pairs (list): List of pairs
-    interval (int, default: None): Minimum number of links, used to set save
-    directory
+    obj (Rolling): Window spec
+    pairs (list): List of (ticker1, ticker2) pairs
     """
 
-    if type == employee_type.ALL:
-        directory = "experiments/random_no_links/random_{}.csv".format(QUARTER)
-    elif type == employee_type.EMPLOYEE:
-        directory = "experiments/employees/interval_{}/employee_{}_{}.csv".format(
-            interval, interval, QUARTER)
-
-    cointegrated = pd.DataFrame(columns=["pair", QUARTER]).set_index("pair")
-
-    for pair in list(pairs):
-        result, p_value = cointegrate(pair[0], pair[1])
-        formatted_pair = str(pair)
-        if result == coint_return.RELATIONSHIP:
-            cointegrated.loc[formatted_pair, QUARTER] = True
-        elif result == coint_return.NO_RELATIONSHIP:
-            cointegrated.loc[formatted_pair, QUARTER] = False
-        else:
-            cointegrated.loc[formatted_pair, QUARTER] = "DISSOLVED"
+    set_quarter(obj)
+    panel = get_panel()
+    panel.load(ticker for pair in pairs for ticker in pair)
+    pairs = [pair for pair in pairs if pair[0] in panel.columns and pair[1] in panel.columns]
 
-    cointegrated.to_csv(directory)
+    with stage("rolling"):
+        starts, p_values = rolling_engle_granger(
+            panel.prices, [(panel.columns[pair[0]], panel.columns[pair[1]]) for pair in pairs],
+            obj.days, obj.step)
 
+    frame = pd.DataFrame(p_values, columns=[date.date().isoformat()
+                                            for date in panel.dates[starts + obj.days - 1]])
+    frame.insert(0, "ticker1", [pair[0] for pair in pairs])
+    frame.insert(1, "ticker2", [pair[1] for pair in pairs])
 
-def sliding_existing(type, previous_quarter, interval=None): # todo, collapse sliding_new and sliding_existing
+    directory = ROLLING_FILE.format(obj.folder)
+    makedirs(path.dirname(directory), exist_ok=True)
+    with stage("results_write"):
+        frame.to_csv(directory, index=False)
+
+    profile_summary(obj.folder)
+#endregion
+
+
+#region Streaming
+def stream_results(quarters, type, interval=1):
     """
-    Generates sliding window results after the first set has been created
+    Cointegrates a pair set for each quarter, yielding one record per pair as
+    each chunk of CHUNK_SIZE pairs is tested; random sets are drawn and
+    validated CHUNK_SIZE candidates at a time, so their records also stream
 
-    Differs from sliding_new by operating on an existing dataframe
+    Each quarter's results are dropped from RESULTS once it is finished, so
+    memory does not grow with the number of quarters
 
     Globals:
-    QUARTER (string): The quarter from which the pairs were selected, used to
-    select existing CSV
+    CHUNK_SIZE (int): Number of pairs tested before records are yielded
+    RANDOM_SET_SIZE (int): Number of pairs in the random set
 
     Parameters:
-    type (employee_type): Whether the pair set is linked or random, used to
-    set save directory
-    previous_quarter (string): Derived from previous Quarter object, used to
-    select existing CSV
-    interval (int, default: None): Minimum number of links, used to set save
-    directory
+    quarters (list): List of quarters of type Quarter
+    type (employee_type): employee_type.EMPLOYEE for linked pairs,
+    employee_type.ALL for a random set of unlinked pairs
+    interval (int, default: 1): Minimum number of links for linked pairs
+
+    Returns:
+    records (generator): Dictionaries with the keys in RECORD_FIELDS
     """
 
-    if type == employee_type.ALL:
-        directory = "experiments/random_no_links/random_{}.csv".format(
-            previous_quarter)
-    elif type == employee_type.EMPLOYEE:
-        directory = "experiments/employees/interval_{}/employee_{}_{}.csv".format(
-            interval, interval, previous_quarter)
-
-    cointegrated = pd.read_csv(directory).set_index("pair")
-    pairs = [literal_eval(p) for p in cointegrated.index.values]
-
-    for pair in pairs:
-        result, p_value = cointegrate(pair[0], pair[1])
-        formatted_pair = str(pair)
-        if result == coint_return.RELATIONSHIP:
-            cointegrated.loc[formatted_pair, QUARTER] = True
-        elif result == coint_return.NO_RELATIONSHIP:
-            cointegrated.loc[formatted_pair, QUARTER] = False
+    for obj in quarters:
+        set_quarter(obj)
+
+        ontology = load_ontology()
+        employee_dict = linked_pairs(ontology, employee_type.EMPLOYEE)
+
+        if type == employee_type.EMPLOYEE:
+            pairs = [pair for pair, links in employee_dict.items() if links >= interval]
+            tested = (tested_pair for start in range(0, len(pairs), CHUNK_SIZE)
+                      for tested_pair in zip(pairs[start:start + CHUNK_SIZE],
+                                             cointegrate_batch(pairs[start:start + CHUNK_SIZE])))
         else:
-            cointegrated.loc[formatted_pair, QUARTER] = "DISSOLVED"
+            companies_list = set(clean_series(
+                str(row[0]).upper() for row in ontology.query(employee_type.ALL)))
+            tested = stream_random_set(list(companies_list), RANDOM_SET_SIZE,
+                                       exclusion_list=set(employee_dict), batch=CHUNK_SIZE)
 
-    cointegrated.to_csv(directory)
+        for pair, (result, p_value) in tested:
+            yield {"quarter": QUARTER, "ticker1": pair[0], "ticker2": pair[1],
+                   "result": result.name,
+                   "p_value": None if p_value is None or np.isnan(p_value) else float(p_value),
+                   "links": employee_dict.get(pair, 0)}
 
+        for key in [key for key in RESULTS if key[0] == QUARTER]:
+            del RESULTS[key]
 
-def generate_linked_results():
+        profile_summary(QUARTER)
+
+
+def write_records(records, output, format="ndjson", fields=None):
+    """
+    Writes records as they are produced, flushing after every record so a
+    downstream job can consume them while the run is in progress
+
+    Parameters:
+    records (iterable): Dictionaries with the keys in fields
+    output (file): Writable text file, e.g. sys.stdout
+    format (string, default: "ndjson"): "ndjson" for one JSON object per
+    line, "csv" for a header followed by one row per record
+    fields (list, default: None): CSV columns, RECORD_FIELDS if None
+    """
+
+    if format == "csv":
+        writer = csv.DictWriter(output, fieldnames=RECORD_FIELDS if fields is None else fields)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(record):
+            output.write(json.dumps(record) + "\n")
+
+    for record in records:
+        write(record)
+        output.flush()
+#endregion
+
+
+#region Scan
+def scan_tiles(n, tile):
+    """
+    Splits the n * (n - 1) / 2 pairs of n items into i x j blocks of at most
+    tile x tile pairs, in the same order as itertools.combinations(range(n), 2)
+    within each block, so the pairs of n items can be enumerated in bounded
+    memory. The blocks only set the order: evaluate_pairs() gathers each
+    pair's prices whatever the block's shape
+
+    Parameters:
+    n (int): Number of items
+    tile (int): Items per side of a block
+
+    Returns:
+    blocks (generator): Arrays of (i, j) item index pairs with i < j
+    """
+
+    for first in range(0, n, tile):
+        rows = np.arange(first, min(first + tile, n))
+        for second in range(first, n, tile):
+            columns = np.arange(second, min(second + tile, n))
+            i, j = np.meshgrid(rows, columns, indexing="ij")
+            upper = i < j
+            if upper.any():
+                yield np.column_stack((i[upper], j[upper]))
+
+
+def scan_batches(n, tile, size):
+    """
+    Groups consecutive blocks of scan_tiles() into batches of at least size
+    pairs, so one evaluate_parallel() call has a chunk for every worker
+
+    Parameters:
+    n (int): Number of items
+    tile (int): Items per side of a block
+    size (int): Minimum number of pairs in a batch, except the last
+
+    Returns:
+    batches (generator): Arrays of (i, j) item index pairs with i < j
     """
-    Generates results for linked companies, outputting the number of
-    cointegrated pairs at each interval
+
+    blocks, pairs = [], 0
+
+    for block in scan_tiles(n, tile):
+        blocks.append(block)
+        pairs += len(block)
+        if pairs >= size:
+            yield np.concatenate(blocks)
+            blocks, pairs = [], 0
+
+    if blocks:
+        yield np.concatenate(blocks)
+
+
+def scan_universe(companies, totals, top=None, tile=None):
+    """
+    Tests every pair of tradeable companies in the quarter, a batch of tiles
+    at a time so only a batch's pairs and results are held in memory. Each
+    batch has CHUNK_SIZE pairs per worker, and one pool of workers is kept
+    for every batch
+
+    Pairs are ordered as in generate_random_set(): companies sorted, first
+    ticker regressed on the second. Results are not kept in RESULTS
 
     Globals:
-    OBJECT_LIST (list): List of quarters of type Quarter
-    COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
-    information for, passed to cointegrate()
-    COINTEGRATION_END_DATE (datetime): End of period to retrieve stock
-    information for, passed to cointegrate()
-    TRADING_DAYS (int): Amount of trading days for the quarter, passed to
-    cointegrate()
-    QUARTER (string): The quarter to select pairs from, passed to multiple
-    methods
+    TRADING_DAYS (int): Amount of trading days for the quarter
+    SCAN_TILE (int): Default tile size
+    WORKERS (int): Number of worker processes
+    CHUNK_SIZE (int): Number of pairs sent to a worker at a time
+    SCREENING (bool): Whether to pre-screen pairs at SCREEN_THRESHOLD
+
+    Parameters:
+    companies (list): List of all companies in ontology
+    totals (dictionary): Filled with the number of companies, pairs, tested
+    (valid) pairs and cointegrated pairs, and the base rate of cointegrated
+    pairs among tested pairs
+    top (int, default: None): Only yield the top pairs with the lowest
+    Engle-Granger p-value, after every tile is tested
+    tile (int, default: None): Companies per side of a tile, SCAN_TILE if
+    None
+
+    Returns:
+    pairs (generator): Tuples of (ticker1, ticker2, coint_return, p_value)
+    for each cointegrated pair as its batch is tested, or for the top pairs
     """
 
-    for obj in OBJECT_LIST:
-        global COINTEGRATION_START_DATE
-        global COINTEGRATION_END_DATE
-        global TRADING_DAYS
-        global QUARTER
+    tile = SCAN_TILE if tile is None else tile
+    panel = get_panel()
+    panel.load(companies)
+    companies = panel.tradeable(sorted(set(companies)), TRADING_DAYS)
+    columns = np.array([panel.columns[company] for company in companies], dtype=np.intp)
+    bits = panel.bitmap()
+    best = []
 
-        COINTEGRATION_START_DATE = obj.start
-        COINTEGRATION_END_DATE = obj.end
-        TRADING_DAYS = obj.days
-        QUARTER = obj.folder
+    totals.update(companies=len(companies), pairs=len(companies) * (len(companies) - 1) // 2,
+                  tested=0, cointegrated=0)
 
-        graph = populate()
-        employee_dict = pairs_with_links(
-            query(graph, employee_type.EMPLOYEE))
+    with price_pool(panel.prices, TRADING_DAYS) as executor:
+        for block in scan_batches(len(companies), tile, max(WORKERS, 1) * CHUNK_SIZE):
+            index_pairs = columns[block]
+            valid = POPCOUNT[bits[index_pairs[:, 0]] & bits[index_pairs[:, 1]]].sum(
+                axis=1, dtype=np.int64) >= TRADING_DAYS
+            block, index_pairs = block[valid], index_pairs[valid]
 
-        cointegrated_count(None, employee_type.ALL, None)
+            with stage("scan"):
+                codes, p_values = evaluate_parallel(panel.prices, index_pairs, TRADING_DAYS, executor=executor,
+                                                    screen=SCREEN_THRESHOLD if SCREENING else None)
 
-        with open("experiments/output/{}.txt".format(QUARTER), "a") as results:
-            for interval in range(1, 6):
-                employee_pairs = [x for x in list(
-                    employee_dict) if employee_dict[x] >= interval]
-                employee_pairs = generate_linked_set(employee_pairs)
+            totals["tested"] += int(np.count_nonzero(codes != coint_return.INVALID.value))
+            totals["cointegrated"] += int(np.count_nonzero(codes == coint_return.RELATIONSHIP.value))
 
-                results.write("\nEmployee set cointegrated ({} links(s)): {}\n".format(
-                    interval, cointegrated_count(employee_pairs, employee_type.ALL, interval)))
-                results.write("Total pairs in employee set: {}\n".format(
-                    len(employee_pairs)))
+            if top is None:
+                for k in np.flatnonzero(codes == coint_return.RELATIONSHIP.value):
+                    yield (companies[block[k, 0]], companies[block[k, 1]],
+                           coint_return.RELATIONSHIP, float(p_values[k]))
+                continue
+
+            best = nsmallest(top, best + [(float(p_values[k]), companies[block[k, 0]], companies[block[k, 1]],
+                                           int(codes[k])) for k in np.flatnonzero(~np.isnan(p_values))])
+
+    totals["base_rate"] = totals["cointegrated"] / totals["tested"] if totals["tested"] else None
+
+    for p_value, ticker1, ticker2, code in best:
+        yield (ticker1, ticker2, coint_return(code), p_value)
 
 
-def generate_survival(type):
+def stream_scan(quarters, top=None):
     """
-    Generates sliding window results for both random and linked pairs
+    Scans every pair of companies in the ontology for each quarter,
+    yielding records in the same format as stream_results() and writing
+    each quarter's exact base rate to stderr
+
+    Parameters:
+    quarters (list): List of quarters of type Quarter
+    top (int, default: None): Only yield the top pairs of each quarter by
+    Engle-Granger p-value, otherwise every cointegrated pair
+
+    Returns:
+    records (generator): Dictionaries with the keys in RECORD_FIELDS
+    """
+
+    for obj in quarters:
+        set_quarter(obj)
+
+        ontology = load_ontology()
+        employee_dict = linked_pairs(ontology, employee_type.EMPLOYEE)
+        companies_list = set(clean_series(
+            str(row[0]).upper() for row in ontology.query(employee_type.ALL)))
+        totals = {}
+
+        for ticker1, ticker2, result, p_value in scan_universe(list(companies_list), totals, top):
+            yield {"quarter": QUARTER, "ticker1": ticker1, "ticker2": ticker2,
+                   "result": result.name, "p_value": p_value,
+                   "links": employee_dict.get((ticker1, ticker2), employee_dict.get((ticker2, ticker1), 0))}
+
+        sys.stderr.write("{}: {} of {} tested pairs cointegrated ({}), {} pairs of {} companies\n".format(
+            QUARTER, totals["cointegrated"], totals["tested"],
+            "n/a" if totals["base_rate"] is None else "{:.4%}".format(totals["base_rate"]),
+            totals["pairs"], totals["companies"]))
+        profile_summary(QUARTER)
+#endregion
+
+
+#region Significance
+def _resample_rates(outcomes, size, count, seed, with_replacement):
+    """
+    Worker task, drawing count sets of size outcomes and returning the share
+    of each set that is cointegrated
+    """
+
+    rng = np.random.default_rng(seed)
+
+    return np.array([outcomes[rng.choice(len(outcomes), size, replace=with_replacement)].mean()
+                     for _ in range(count)])
+
+
+def resample_rates(outcomes, size, resamples, with_replacement=False, seed=RANDOM_SEED, workers=None):
+    """
+    Cointegration rates of many pair sets drawn from pairs already tested,
+    so each resample is an index into an array of outcomes rather than a
+    test
+
+    Resamples are split into tasks of SIGNIFICANCE_CHUNK with their own
+    seeds, run across a process pool, so the rates are the same whatever
+    the number of workers
+
+    Parameters:
+    outcomes (numpy.ndarray): Whether each tested pair is cointegrated
+    size (int): Number of pairs in each set
+    resamples (int): Number of sets
+    with_replacement (bool, default: False): Whether to draw with
+    replacement, as a bootstrap does. Sets larger than outcomes are always
+    drawn with replacement
+    seed (int or list, default: RANDOM_SEED): Seed for reproducible draws
+    workers (int, default: None): Number of worker processes, every core if
+    None
+
+    Returns:
+    rates (numpy.ndarray): Share of each set that is cointegrated
+    """
+
+    workers = cpu_count() if workers is None else workers
+    outcomes = np.asarray(outcomes, dtype=bool)
+    if len(outcomes) == 0 or size == 0:
+        return np.full(resamples, np.nan)
+
+    with_replacement = with_replacement or size > len(outcomes)
+    counts = [min(SIGNIFICANCE_CHUNK, resamples - first) for first in range(0, resamples, SIGNIFICANCE_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    tasks = [(outcomes, size, count, task_seed, with_replacement) for count, task_seed in zip(counts, seeds)]
+
+    if workers > 1 and len(tasks) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return np.concatenate(list(executor.map(_resample_rates, *zip(*tasks))))
+        except (OSError, BrokenProcessPool):
+            pass
+
+    return np.concatenate([_resample_rates(*task) for task in tasks]) if tasks else np.zeros(0)
+
+
+def significance(quarters, resamples=None, confidence=None, pool=None, workers=None, intervals=None):
+    """
+    Tests whether linked pairs cointegrate more often than random unlinked
+    pairs, for each quarter and minimum number of links
+
+    A pool of random unlinked pairs is tested once per quarter, as
+    generate_random_set() draws them. The rate of the linked set is compared
+    with the rates of resampled random sets of the same size drawn from the
+    pool, giving a one-sided empirical p-value, and bootstrapped for its
+    confidence interval
 
     Globals:
-    OBJECT_LIST (list): List of quarters of type Quarter
-    COINTEGRATION_START_DATE (datetime): Start of period to retrieve stock
-    information for, passed to cointegrate()
-    COINTEGRATION_END_DATE (datetime): End of period to retrieve stock
-    information for, passed to cointegrate()
-    TRADING_DAYS (int): Amount of trading days for the quarter, passed to
-    cointegrate()
-    QUARTER (string): The quarter to select pairs from, passed to multiple
-    methods
+    SIGNIFICANCE_RESAMPLES (int): Default number of resamples
+    SIGNIFICANCE_CONFIDENCE (float): Default confidence level
+    RANDOM_SET_SIZE (int): Default pool size
+    LINK_INTERVALS (list): Default minimum numbers of links
 
     Parameters:
-    type (employee_type): Whether the pair set is linked or random, used to
-    set save directory
+    quarters (list): List of quarters of type Quarter
+    resamples (int, default: None): Number of resampled sets
+    confidence (float, default: None): Confidence level of the intervals
+    pool (int, default: None): Number of random unlinked pairs to resample
+    workers (int, default: None): Number of worker processes, every core if
+    None
+    intervals (list, default: None): Minimum numbers of links to test,
+    LINK_INTERVALS if None
+
+    Returns:
+    records (generator): Dictionaries with the keys in SIGNIFICANCE_FIELDS:
+    the linked set's size, rate and interval, the pool's size and the mean
+    and interval of the resampled rates, the p-value and resample count
     """
 
-    previous_quarter = None
+    resamples = SIGNIFICANCE_RESAMPLES if resamples is None else resamples
+    confidence = SIGNIFICANCE_CONFIDENCE if confidence is None else confidence
+    pool = RANDOM_SET_SIZE if pool is None else pool
+    intervals = LINK_INTERVALS if intervals is None else intervals
+    tails = [(1 - confidence) / 2, (1 + confidence) / 2]
+
+    for obj in quarters:
+        set_quarter(obj)
+
+        ontology = load_ontology()
+        employee_dict = linked_pairs(ontology, employee_type.EMPLOYEE)
+        companies_list = set(clean_series(
+            str(row[0]).upper() for row in ontology.query(employee_type.ALL)))
+        random_pairs = generate_random_set(list(companies_list), pool, exclusion_list=set(employee_dict))
+        random_outcomes = np.array([result == coint_return.RELATIONSHIP
+                                    for result, _ in cointegrate_batch(random_pairs)], dtype=bool)
+
+        employee_pairs, links = stratify_linked_set(employee_dict)
+        linked_outcomes = np.array([result == coint_return.RELATIONSHIP
+                                    for result, _ in cointegrate_batch(employee_pairs)], dtype=bool)
+
+        for interval in intervals:
+            outcomes = linked_outcomes[links >= interval]
+            if not len(outcomes) or not random_pairs:
+                continue
+
+            rate = outcomes.mean()
+
+            with stage("resample"):
+                null = resample_rates(random_outcomes, len(outcomes), resamples,
+                                      seed=[RANDOM_SEED, interval, 0], workers=workers)
+                bootstrap = resample_rates(outcomes, len(outcomes), resamples, with_replacement=True,
+                                           seed=[RANDOM_SEED, interval, 1], workers=workers)
+
+            linked_low, linked_high = np.quantile(bootstrap, tails)
+            random_low, random_high = np.quantile(null, tails)
+
+            yield {"quarter": QUARTER, "interval": interval, "linked_pairs": len(outcomes),
+                   "linked_rate": float(rate), "linked_low": float(linked_low),
+                   "linked_high": float(linked_high), "random_pairs": len(random_outcomes),
+                   "random_rate": float(null.mean()), "random_low": float(random_low),
+                   "random_high": float(random_high),
+                   "p_value": float((1 + np.count_nonzero(null >= rate)) / (1 + resamples)),
+                   "resamples": resamples}
+
+        profile_summary(QUARTER)
+#endregion
 
-    for obj in OBJECT_LIST:
-        global COINTEGRATION_START_DATE
-        global COINTEGRATION_END_DATE
-        global TRADING_DAYS
-        global QUARTER
 
-        COINTEGRATION_START_DATE = obj.start
-        COINTEGRATION_END_DATE = obj.end
-        TRADING_DAYS = obj.days
-        QUARTER = obj.folder
+#region Service
+class QuarterIndex:
+    def __init__(self, quarter, people, panel):
+        self.quarter = quarter
+        self.people = people  # pair -> names, as returned by linked_people()
+        self.panel = panel
+        self.neighbours = {}
 
-        graph = populate()
-        employee_dict = pairs_with_links(
-            query(graph, employee_type.EMPLOYEE))
+        for pair, names in people.items():
+            self.neighbours.setdefault(pair[0], []).append(pair)
+            self.neighbours.setdefault(pair[1], []).append(pair)
 
-        if type == employee_type.ALL:
-            companies_list = set()
-            for row in query(graph, employee_type.ALL):
-                companies_list.add(clean(str(row[0]).upper()))
-            employee_pairs = [x for x in list(
-                employee_dict) if employee_dict[x] >= 1]
-            random_pairs = generate_random_set(
-                list(companies_list), RANDOM_SET_SIZE, exclusion_list=set(employee_pairs))
-
-            sliding_new(type, random_pairs)
-            if previous_quarter is not None:
-                sliding_existing(type, previous_quarter)
-            previous_quarter = QUARTER
 
-        elif type == employee_type.EMPLOYEE:
-            for interval in range(1, 6):
-                employee_pairs = [x for x in list(
-                    employee_dict) if employee_dict[x] >= interval]
-                employee_pairs = generate_linked_set(employee_pairs)
+def _evaluate_store(filename, columns, days, pairs, screen):
+    """
+    Service worker task, cointegrating pairs against a quarter's binary
+    store, memory-mapped once per process and again only when tickers have
+    been added to it
+    """
 
-                sliding_new(type, employee_pairs, interval=interval)
-                if previous_quarter is not None:
-                    sliding_existing(type, previous_quarter, interval=interval)
-            previous_quarter = QUARTER
+    global WORKER_PRICES, WORKER_STORE
+
+    if WORKER_STORE != (filename, columns):
+        WORKER_PRICES = np.load(filename, mmap_mode="r")
+        WORKER_STORE = (filename, columns)
+
+    return evaluate_pairs(WORKER_PRICES, pairs, days, screen)
+
+
+class QueryService:
+    def __init__(self, workers=None):
+        self.indexes = {}
+        self.loader = ThreadPoolExecutor(max_workers=1)  # the only thread touching the quarter globals and panels
+        self.pool = ProcessPoolExecutor(max_workers=max(WORKERS if workers is None else workers, 1),
+                                        mp_context=get_context("forkserver"))  # not forked from the threads above
+
+    def _load(self, name):
+        """
+        Loads a quarter's linked pairs and price panel, on the loader thread
+
+        Parameters:
+        name (string): Quarter, e.g. "2017Q4"
+
+        Returns:
+        index (QuarterIndex): The quarter's linked pairs and panel
+        """
+
+        obj = get_quarter(name)
+        set_quarter(obj)
+
+        with stage("service_load"):
+            people = linked_people(load_ontology(), employee_type.EMPLOYEE)
+
+        return QuarterIndex(obj, people, PricePanel(obj.folder, obj.dates))
+
+    async def index(self, name):
+        """
+        Retrieves a quarter's index, loading it the first time it is asked
+        for; concurrent requests for a quarter being loaded wait on the same
+        load
+
+        Parameters:
+        name (string): Quarter, e.g. "2017Q4"
+
+        Returns:
+        index (QuarterIndex): The quarter's linked pairs and panel
+        """
+
+        if name not in self.indexes:
+            self.indexes[name] = asyncio.get_running_loop().run_in_executor(self.loader, self._load, name)
+
+        try:
+            return await self.indexes[name]
+        except Exception:
+            self.indexes.pop(name, None)  # retried by the next request
+            raise
+
+    def _extend(self, index, tickers):
+        """
+        Adds tickers already downloaded by prefetch() to a quarter's panel, on
+        the loader thread
+
+        Parameters:
+        index (QuarterIndex): Quarter of the tickers
+        tickers (list): Stock tickers not yet in the panel
+        """
+
+        set_quarter(index.quarter)
+        index.panel.load(tickers)
+
+    def _prepare(self, index, untested):
+        """
+        Looks up the panel columns of the untested pairs. PricePanel.load()
+        extends the prices before the columns, so the prices read after the
+        columns hold every column found
+
+        Parameters:
+        index (QuarterIndex): Quarter of the pairs
+        untested (list): RESULTS keys of the pairs not yet tested
+
+        Returns:
+        known (list): Keys of the untested pairs with prices
+        index_pairs (numpy.ndarray): Panel columns of the known pairs
+        prices (numpy.ndarray): The panel's prices
+        """
+
+        columns = index.panel.columns
+        known = [key for key in untested if key[1] in columns and key[2] in columns]
+        index_pairs = np.array([(columns[key[1]], columns[key[2]]) for key in known],
+                               dtype=np.intp).reshape(-1, 2)
+
+        return known, index_pairs, index.panel.prices
+
+    async def cointegrate(self, index, pairs, pool=False):
+        """
+        Cointegrates pairs in a quarter with the same semantics as
+        cointegrate_batch(), sharing its RESULTS
+
+        Tickers not yet in the panel are downloaded on the default thread
+        pool, then added to the panel on the loader thread. Small requests
+        are evaluated on the default thread pool. Requests with pool set are
+        split into CHUNK_SIZE chunks evaluated by the worker processes, so a
+        large batch does not hold up the small requests. RESULTS is only read
+        and written on the event loop
+
+        Globals:
+        CHUNK_SIZE (int): Number of pairs sent to a worker at a time
+        SCREENING (bool): Whether to pre-screen pairs at SCREEN_THRESHOLD
+
+        Parameters:
+        index (QuarterIndex): Quarter of the pairs
+        pairs (list): List of (ticker1, ticker2) pairs
+        pool (bool, default: False): Whether to use the worker processes
+
+        Returns:
+        results (list): List of (coint_return, p_value) tuples in the same
+        order as pairs
+        """
+
+        loop = asyncio.get_running_loop()
+        panel = index.panel
+        keys = [(index.quarter.folder, pair[0], pair[1]) for pair in pairs]
+        untested = list(dict.fromkeys(key for key in keys if key not in RESULTS))
+
+        unloaded = list(dict.fromkeys(ticker for key in untested for ticker in key[1:]
+                                      if ticker not in panel.columns and ticker not in panel.missing))
+        if unloaded:
+            await loop.run_in_executor(None, partial(prefetch, unloaded, quarter=index.quarter))
+            await loop.run_in_executor(self.loader, self._extend, index, unloaded)
+
+        known, index_pairs, prices = await loop.run_in_executor(None, self._prepare, index, untested)
+        for key in set(untested).difference(known):
+            RESULTS[key] = (coint_return.INVALID, None)
+        screen = SCREEN_THRESHOLD if SCREENING else None
+
+        if known and pool and isinstance(prices, np.memmap) and prices.filename is not None:
+            chunks = np.array_split(index_pairs, -(-len(index_pairs) // CHUNK_SIZE))
+            outputs = await asyncio.gather(*(loop.run_in_executor(
+                self.pool, _evaluate_store, prices.filename, prices.shape[1], index.quarter.days, chunk, screen)
+                for chunk in chunks))
+            record_results(known, np.concatenate([codes for codes, _ in outputs]),
+                           np.concatenate([p_values for _, p_values in outputs]))
+        elif known:
+            codes, p_values = await loop.run_in_executor(
+                None, evaluate_pairs, prices, index_pairs, index.quarter.days, screen)
+            record_results(known, codes, p_values)
+
+        return [RESULTS[key] for key in keys]
+
+    def record(self, index, pair, result):
+        """
+        Formats a pair's result in the format of stream_results(), with the
+        names of the people linking the pair
+
+        Parameters:
+        index (QuarterIndex): Quarter of the pair
+        pair (tuple): Pair of tickers
+        result (tuple): Tuple of coint_return and p-value
+
+        Returns:
+        record (dictionary): Record with the keys in RECORD_FIELDS and people
+        """
+
+        people = index.people.get(pair, index.people.get((pair[1], pair[0]), set()))
+        p_value = None if result[1] is None or np.isnan(result[1]) else float(result[1])
+
+        return {"quarter": index.quarter.folder, "ticker1": pair[0], "ticker2": pair[1],
+                "result": result[0].name, "p_value": p_value, "links": len(people),
+                "people": sorted(people)}
+
+    async def pair(self, quarter, ticker1, ticker2):
+        """
+        Whether two companies are cointegrated in a quarter, ticker1
+        regressed on ticker2, and who links them
+
+        Parameters:
+        quarter (string): Quarter, e.g. "2017Q4"
+        ticker1 (string): First stock ticker of pair
+        ticker2 (string): Second stock ticker of pair
+
+        Returns:
+        record (dictionary): As returned by record()
+        """
+
+        index = await self.index(quarter)
+        pair = (clean(ticker1.upper()), clean(ticker2.upper()))
+        result, = await self.cointegrate(index, [pair])
+
+        return self.record(index, pair, result)
+
+    async def neighbours(self, quarter, ticker):
+        """
+        Every company linked to a ticker in a quarter, each pair in canonical
+        order with its result and the people linking it
+
+        Parameters:
+        quarter (string): Quarter, e.g. "2017Q4"
+        ticker (string): Stock ticker
+
+        Returns:
+        neighbourhood (dictionary): Quarter, cleaned ticker and list of
+        records of its linked pairs
+        """
+
+        index = await self.index(quarter)
+        ticker = clean(ticker.upper())
+        pairs = index.neighbours.get(ticker, [])
+        results = await self.cointegrate(index, pairs)
+
+        return {"quarter": index.quarter.folder, "ticker": ticker,
+                "neighbours": [self.record(index, pair, result) for pair, result in zip(pairs, results)]}
+
+    async def batch(self, quarter, pairs):
+        """
+        Cointegrates a list of [ticker1, ticker2] pairs on the worker
+        processes
+
+        Parameters:
+        quarter (string): Quarter, e.g. "2017Q4"
+        pairs (list): List of [ticker1, ticker2] pairs
+
+        Returns:
+        batch (dictionary): Quarter and list of records in the order of pairs
+        """
+
+        index = await self.index(quarter)
+        pairs = [(clean(str(ticker1).upper()), clean(str(ticker2).upper())) for ticker1, ticker2 in pairs]
+        results = await self.cointegrate(index, pairs, pool=True)
+
+        return {"quarter": index.quarter.folder,
+                "results": [self.record(index, pair, result) for pair, result in zip(pairs, results)]}
+
+    async def dispatch(self, method, target, body):
+        """
+        Routes a request
+
+        GET /pair?quarter=2017Q4&ticker1=AAPL&ticker2=MSFT
+        GET /neighbours?quarter=2017Q4&ticker=AAPL
+        POST /batch with {"quarter": "2017Q4", "pairs": [["AAPL", "MSFT"]]}
+
+        Returns:
+        status (int): HTTP status
+        payload (dictionary): JSON response
+        """
+
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        routes = {"/pair": "GET", "/neighbours": "GET", "/batch": "POST"}
+
+        if url.path not in routes:
+            return 404, {"error": "unknown path {}".format(url.path)}
+        if method != routes[url.path]:
+            return 405, {"error": "{} expects {}".format(url.path, routes[url.path])}
+
+        try:
+            if url.path == "/pair":
+                return 200, await self.pair(query["quarter"], query["ticker1"], query["ticker2"])
+            elif url.path == "/neighbours":
+                return 200, await self.neighbours(query["quarter"], query["ticker"])
+            else:
+                request = json.loads(body or b"{}")
+                return 200, await self.batch(request["quarter"], request["pairs"])
+        except KeyError as error:
+            return 400, {"error": "missing {}".format(error)}
+        except (ValueError, TypeError) as error:
+            return 400, {"error": str(error)}
+        except Exception as error:
+            sys.stderr.write("{} {}: {!r}\n".format(method, target, error))
+            return 500, {"error": str(error)}
+
+    async def handle(self, reader, writer):
+        """
+        Answers one HTTP/1.1 request per connection with a JSON response
+        """
+
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                   405: "Method Not Allowed", 500: "Internal Server Error"}
+
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            if len(request) != 3:
+                return
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self.dispatch(request[0], request[1], body)
+            data = json.dumps(payload).encode()
+
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                         "Connection: close\r\n\r\n".format(status, reasons[status], len(data)).encode() + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host=SERVICE_HOST, port=SERVICE_PORT, socket=None, quarters=()):
+        """
+        Loads the given quarters, then serves until cancelled
+
+        Parameters:
+        host (string, default: SERVICE_HOST): Address to listen on
+        port (int, default: SERVICE_PORT): Port to listen on
+        socket (string, default: None): Unix socket to listen on instead of
+        host and port
+        quarters (list, default: ()): Quarters to load before serving
+        """
+
+        for quarter in quarters:
+            await self.index(quarter)
+
+        if socket is None:
+            server = await asyncio.start_server(self.handle, host, port)
+        else:
+            server = await asyncio.start_unix_server(self.handle, socket)
+
+        sys.stderr.write("Serving on {}\n".format(
+            socket or ", ".join("{}:{}".format(*sock.getsockname()[:2]) for sock in server.sockets)))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.loader.shutdown(cancel_futures=True)
+            self.pool.shutdown(cancel_futures=True)
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, socket=None, quarters=(), workers=None):
+    """
+    Runs the query service: each quarter's linked pairs and prices are
+    loaded once and kept in memory, and pair, neighbourhood and batch
+    queries are answered over HTTP on a local port or Unix socket
+
+    Parameters:
+    host (string, default: SERVICE_HOST): Address to listen on
+    port (int, default: SERVICE_PORT): Port to listen on
+    socket (string, default: None): Unix socket to listen on instead of host
+    and port
+    quarters (list, default: ()): Quarters to load before serving
+    workers (int, default: None): Worker processes for batch queries,
+    WORKERS if None
+    """
+
+    try:
+        asyncio.run(QueryService(workers).run(host, port, socket, quarters))
+    except KeyboardInterrupt:
+        pass
+#endregion
+
+
+#region Command line
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Cointegration experiments over the financial ontology")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes used for cointegration (default: 1, serial)")
+    parser.add_argument("--prices", metavar="DIRECTORY",
+                        help="read uncached prices from <DIRECTORY>/<ticker>.csv instead of Yahoo Finance")
+    parser.add_argument("--screen", type=float, nargs="?", const=SCREEN_THRESHOLD, metavar="THRESHOLD",
+                        help="skip the full test for pairs whose lag-0 Dickey-Fuller statistic is above "
+                        "THRESHOLD (default: {})".format(SCREEN_THRESHOLD))
+    parser.add_argument("--profile", action="store_true",
+                        help="write stage timings and result counts for each quarter to stderr")
+    subparsers = parser.add_subparsers(dest="experiment", required=True)
+
+    run = subparsers.add_parser("run", help="stream one record per pair to stdout or a file")
+    run.add_argument("--quarters", nargs="+", default=[obj.folder for obj in OBJECT_LIST],
+                     metavar="QUARTER", help="quarters to test, e.g. 2017Q2 (default: all)")
+    run.add_argument("--set", choices=["linked", "random"], default="linked",
+                     help="linked pairs, or a random set of unlinked pairs (default: linked)")
+    run.add_argument("--interval", type=int, default=1,
+                     help="minimum number of links for linked pairs (default: 1)")
+    run.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    run.add_argument("--output", default="-", help="output file, - for stdout (default: -)")
+
+    rolling = subparsers.add_parser("rolling", help="write Engle-Granger p-values over rolling windows "
+                                    "for every linked pair to experiments/rolling/")
+    rolling.add_argument("--start", default=OBJECT_LIST[0].start, help="first date of the history")
+    rolling.add_argument("--end", default=OBJECT_LIST[-1].end, help="last date of the history")
+    rolling.add_argument("--days", type=int, default=63, help="trading days per window (default: 63)")
+    rolling.add_argument("--step", type=int, default=1, help="trading days between windows (default: 1)")
+    rolling.add_argument("--interval", type=int, default=1,
+                         help="minimum number of links in any quarter (default: 1)")
+
+    report = subparsers.add_parser("screen-report", help="check the pre-screen against the results in "
+                                   "experiments/, as CSV on stdout")
+    report.add_argument("--threshold", type=float, default=SCREEN_THRESHOLD,
+                        help="threshold to check (default: {})".format(SCREEN_THRESHOLD))
+
+    scan = subparsers.add_parser("scan", help="test every pair of companies, streaming the cointegrated "
+                                 "pairs and writing the base rate to stderr")
+    scan.add_argument("--quarters", nargs="+", default=[obj.folder for obj in OBJECT_LIST],
+                      metavar="QUARTER", help="quarters to scan, e.g. 2017Q2 (default: all)")
+    scan.add_argument("--top", type=int, help="only write the TOP pairs with the lowest p-value per quarter")
+    scan.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    scan.add_argument("--output", default="-", help="output file, - for stdout (default: -)")
+
+    test = subparsers.add_parser("significance", help="compare linked and random cointegration rates by "
+                                 "resampling, for each quarter and interval")
+    test.add_argument("--quarters", nargs="+", default=[obj.folder for obj in OBJECT_LIST],
+                      metavar="QUARTER", help="quarters to test, e.g. 2017Q2 (default: all)")
+    test.add_argument("--resamples", type=int, default=SIGNIFICANCE_RESAMPLES,
+                      help="resampled sets per interval (default: {})".format(SIGNIFICANCE_RESAMPLES))
+    test.add_argument("--confidence", type=float, default=SIGNIFICANCE_CONFIDENCE,
+                      help="confidence level of the intervals (default: {})".format(SIGNIFICANCE_CONFIDENCE))
+    test.add_argument("--pool", type=int, default=RANDOM_SET_SIZE,
+                      help="random unlinked pairs tested per quarter (default: {})".format(RANDOM_SET_SIZE))
+    test.add_argument("--intervals", nargs="+", type=int, default=LINK_INTERVALS, metavar="LINKS",
+                      help="minimum numbers of links (default: {})".format(" ".join(map(str, LINK_INTERVALS))))
+    test.add_argument("--format", choices=["ndjson", "csv"], default="csv")
+    test.add_argument("--output", default="-", help="output file, - for stdout (default: -)")
+
+    summary = subparsers.add_parser("survival-summary", help="survival curves, hazard rates and transitions "
+                                    "of every pair set in experiments/, as one table")
+    summary.add_argument("--output", default="-", help="output CSV, - for stdout (default: -)")
+
+    linked = subparsers.add_parser("linked", help="write linked cointegration counts to experiments/output/")
+    linked.add_argument("--intervals", nargs="+", type=int, default=LINK_INTERVALS, metavar="LINKS",
+                        help="minimum numbers of links (default: {})".format(
+                            " ".join(map(str, LINK_INTERVALS))))
+    migrate = subparsers.add_parser("migrate", help="convert per-ticker CSV price caches to binary stores")
+    migrate.add_argument("--quarters", nargs="+", metavar="QUARTER",
+                         help="quarters to convert, e.g. 2017Q2 (default: every folder in stocks/)")
+    service = subparsers.add_parser("serve", help="answer pair, neighbourhood and batch queries over HTTP, "
+                                    "keeping each quarter in memory")
+    service.add_argument("--host", default=SERVICE_HOST, help="address (default: {})".format(SERVICE_HOST))
+    service.add_argument("--port", type=int, default=SERVICE_PORT, help="port (default: {})".format(SERVICE_PORT))
+    service.add_argument("--socket", metavar="PATH", help="listen on a Unix socket instead of --host/--port")
+    service.add_argument("--quarters", nargs="+", default=[], metavar="QUARTER",
+                         help="quarters to load before serving, e.g. 2017Q2 (default: on first query)")
+    for name in ["survival-employee", "survival-random"]:
+        survival = subparsers.add_parser(name, help="write sliding window results to experiments/")
+        survival.add_argument("--incremental", action="store_true",
+                              help="only compute results missing from experiments/, resuming from checkpoints")
+        if name == "survival-employee":
+            survival.add_argument("--intervals", nargs="+", type=int, default=LINK_INTERVALS, metavar="LINKS",
+                                  help="minimum numbers of links (default: {})".format(
+                                      " ".join(map(str, LINK_INTERVALS))))
+    args = parser.parse_args()
+
+    WORKERS = args.workers
+    PROFILE = args.profile
+    if args.screen is not None:
+        SCREENING = True
+        SCREEN_THRESHOLD = args.screen
+    if args.prices is not None:
+        DATA_SOURCE = DirectorySource(args.prices)
+
+    if args.experiment in ["run", "scan", "significance"]:
+        try:
+            quarters = [get_quarter(quarter) for quarter in args.quarters]
+        except ValueError as error:
+            parser.error(str(error))
+
+        fields = RECORD_FIELDS
+        if args.experiment == "scan":
+            records = stream_scan(quarters, args.top)
+        elif args.experiment == "significance":
+            records = significance(quarters, args.resamples, args.confidence, args.pool,
+                                   workers=args.workers, intervals=args.intervals)
+            fields = SIGNIFICANCE_FIELDS
+        else:
+            type = employee_type.EMPLOYEE if args.set == "linked" else employee_type.ALL
+            records = stream_results(quarters, type, args.interval)
+
+        if args.output == "-":
+            write_records(records, sys.stdout, args.format, fields)
+        else:
+            with open(args.output, "w", newline="") as output:
+                write_records(records, output, args.format, fields)
+    elif args.experiment == "rolling":
+        pairs = rolling_pairs(OBJECT_LIST, args.interval)
+        generate_rolling(Rolling(args.start, args.end, args.days, args.step,
+                                 "{}_{}".format(args.start, args.end)), pairs)
+    elif args.experiment == "screen-report":
+        writer = None
+        for record in screen_report(args.threshold):
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(record))
+                writer.writeheader()
+            writer.writerow(record)
+            sys.stdout.flush()
+    elif args.experiment == "survival-summary":
+        survival_summary().to_csv(sys.stdout if args.output == "-" else args.output, index=False)
+    elif args.experiment == "linked":
+        generate_linked_results(args.intervals)
+    elif args.experiment == "migrate":
+        try:
+            migrate_csv_cache(args.quarters)
+        except ValueError as error:
+            parser.error(str(error))
+    elif args.experiment == "serve":
+        serve(args.host, args.port, args.socket, args.quarters)
+    elif args.experiment == "survival-employee":
+        generate_survival(employee_type.EMPLOYEE, incremental=args.incremental, intervals=args.intervals)
+    else:
+        generate_survival(employee_type.ALL, incremental=args.incremental)
 #endregion